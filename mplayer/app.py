@@ -26,27 +26,83 @@ class Application(object):
 class Identifier(Application):
     def __init__(self,args):
         super(Identifier, self).__init__(args)
-        self.args = args
+        self.jobs = 1
+        self.format = None
+        self.args = []
+        while args:
+            s = args.pop(0)
+            if s.startswith('--jobs'):
+                self.jobs = max(1, int(s.partition('=')[2] or args.pop(0)))
+            elif s.startswith('--format'):
+                self.format = s.partition('=')[2] or args.pop(0)
+            else:
+                self.args.append(s)
 
     def run(self):
         from mplayer import MPlayer
-        print(MPlayer(minimal=True).identify(self.args))
+        if self.format == 'ndjson':
+            self.__run_ndjson(MPlayer(minimal=True))
+        else:
+            print(MPlayer(minimal=True).identify(self.args))
+
+    def __run_ndjson(self, mplayer):
+        '''Identify the files in a pool of self.jobs threads (the real work is
+        done by mplayer subprocesses) and print one JSON record per file as
+        soon as it is identified.
+        '''
+        import json, sys
+        from aux import imap_unordered
+
+        def identify(f):
+            info = {}
+            for l in mplayer.identify([f]).splitlines():
+                k,_,v = l.partition('=')
+                info.setdefault(k, []).append(v)
+            return info
+
+        for i, info, error in imap_unordered(identify, self.args, self.jobs):
+            record = {'path': self.args[i], 'info': info}
+            if error:
+                record['error'] = str(error)
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+            sys.stdout.flush()
         
 class Fetcher(Application):
     def __init__(self, args):
         super(Fetcher,self).__init__(args)
         self.savedir = None
+        self.jobs = 1
         self.files = []
-        for arg in args:
+        while args:
+            arg = args.pop(0)
             if arg.startswith('--savedir'):
                 self.savedir = arg.split('=')[1]
+            elif arg.startswith('--jobs'):
+                self.jobs = max(1, int(arg.partition('=')[2] or args.pop(0)))
             else:
                 self.files.append(arg)
 
     def run(self):
         from media import Media
-        for f in self.files:
-            Media(f).fetch_remote_subtitles(self.savedir)
+        from aux import imap_unordered
+        from globals import log_info
+
+        def fetch(f):
+            return Media(f).fetch_remote_subtitles(self.savedir)
+
+        # report in the order of the files
+        results = {}
+        reported = 0
+        for i, subs, error in imap_unordered(fetch, self.files, self.jobs):
+            results[i] = (subs, error)
+            while reported in results:
+                subs, error = results.pop(reported)
+                f = self.files[reported]
+                reported += 1
+                if error:
+                    log_info('[{0}/{1}] {2}: failed because {3}'.format(reported, len(self.files), f, error))
+                else:
+                    log_info('[{0}/{1}] {2}: {3} subtitle(s)'.format(reported, len(self.files), f, len(subs)))
             
 class Player(Application):
     def __init__(self, args):
@@ -75,20 +131,56 @@ class Player(Application):
             log_info('Unknown option(s) "' + ' '.join(invalid) + '" are ignored.')
 
     def run(self):
+        from aux import is_stream
         if not self.playlist:
-            singleton.get_mplayer().play()
+            # e.g. mplayer -list-options
+            singleton.get_mplayer().play(replace=True)
+        elif all(is_stream(f) for f in self.playlist):
+            # there is nothing to be fixed or fetched for streams
+            singleton.get_mplayer().play(self.playlist, replace=True)
         else:
             self.__run_playlist()
 
     def __run_playlist(self):
         import threading, time
-        # Use a separate thread to reduce the noticeable lag when finding
-        # episodes in a big directory.
+        from media import Media
+
+        # Prepare the following entries (identify, subtitle conversion and
+        # fetching) in the background while the current one is playing.
+        # Playing waits only for the arguments; a slow subtitle query goes on
+        # and its results are loaded by the watchdog thread.
+        preparing = {}
+        prepared = {}
+        def prepare(f, ready):
+            try:
+                m = Media(f)
+                m.prepare_mplayer_args()
+                prepared[f] = m
+            except StandardError as e:
+                from globals import log_debug
+                log_debug('Preparing {0} failed because:\n  {1}'.format(f, e))
+                return
+            finally:
+                ready.set()
+            if m.is_video():
+                m.fetch_if_no_local_subtitles(preload=True)
+        def lookahead():
+            with playlist_lock:
+                for f in self.playlist[0:config.PLAYLIST_LOOKAHEAD]:
+                    if not f in preparing:
+                        preparing[f] = threading.Event()
+                        t = threading.Thread(target=prepare, args=(f,preparing[f]))
+                        t.daemon = True
+                        t.start()
+
+        # Find episodes in a separate thread so that a big directory never
+        # delays the start of playback.
         def generate_playlist(playlist_seed, lock):
             from aux import find_more_episodes
-            time.sleep(1.5)
+            episodes = find_more_episodes(playlist_seed)
             with lock:
-                self.playlist += find_more_episodes(playlist_seed)
+                self.playlist += episodes
+            lookahead()
         playlist_lock = threading.Lock()
         playlist_thread = threading.Thread(target=generate_playlist, args=(self.playlist[-1],playlist_lock))
         playlist_thread.daemon = True
@@ -97,13 +189,19 @@ class Player(Application):
         # Watchdog thread
         def watch(m):
             # wait for media setting up
-            time.sleep(3.0)
-            m.fetch_if_no_local_subtitles()
-        from media import Media
+            while not m.is_prepared():
+                time.sleep(0.1)
+            if m.is_video():
+                singleton.get_mplayer().wait_until_playing()
+                m.fetch_if_no_local_subtitles()
         while self.playlist:
             with playlist_lock:
                 f = self.playlist.pop(0)
-            m = Media(f)
+                ready = preparing.pop(f, None)
+            lookahead()
+            if ready:
+                ready.wait()
+            m = prepared.pop(f, None) or Media(f)
             watch_thread = threading.Thread(target=watch, args=(m,))
             watch_thread.daemon = True
             watch_thread.start()
@@ -114,5 +212,3 @@ class Player(Application):
                 break
 
             playlist_thread.join()
-            
-            
@@ -7,7 +7,7 @@
 # A standalone module for auxiliary functions.
 from __future__ import unicode_literals
 from __future__ import print_function
-import os,sys
+import os,sys,re
 
 def which(prog):
     paths = [''] if os.path.isabs(prog) else os.environ['PATH'].split(os.pathsep)
@@ -39,89 +39,380 @@ else:
             stream = os.fsdecode(stream)
         return stream
 
+def is_stream(path):
+    '''Return True if path is a network stream URL.
+    '''
+    scheme,sep,_ = path.partition('://')
+    return bool(sep) and scheme.lower() in ['http', 'https', 'ftp', 'mms', 'mmsh', 'mmst',
+                                            'rtsp', 'rtmp', 'rtp', 'udp'] and not os.path.exists(path)
+
+def imap_unordered(func, items, jobs):
+    '''Apply func to items in a pool of jobs threads. Yield (index, result,
+    exception) as soon as each call returns.
+    '''
+    import threading
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    todo = queue.Queue()
+    done = queue.Queue()
+    for i,item in enumerate(items):
+        todo.put((i,item))
+
+    def worker():
+        while True:
+            try:
+                i,item = todo.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                done.put((i, func(item), None))
+            except Exception as e:
+                done.put((i, None, e))
+
+    for n in range(min(jobs, len(items))):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+
+    for n in range(len(items)):
+        while True:
+            # a blocking get() without timeout can't be interrupted by Ctrl-C
+            try:
+                yield done.get(True, 1)
+                break
+            except queue.Empty:
+                pass
+
+def file_identity(path):
+    '''Return 'device:inode:size:mtime' of the file, by which the caches tell
+    whether it is still the same file with the same content.
+    '''
+    st = os.stat(path)
+    mtime = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 10**9)
+    return '{0}:{1}:{2}:{3}'.format(st.st_dev, st.st_ino, st.st_size, mtime)
+
 #def notify():
 #    try import 
     
 def find_more_episodes(filepath):
     '''Try to find some following episodes/parts.
-    '''
-    def translate(s):
-        dic = dict(zip('零壹贰叁肆伍陆柒捌玖〇一二三四五六七八九','0123456789'*2))
-        return ''.join([dic.get(c,c) for c in s])
-    def split_by_int(s):
-        res = [(int(x) if x.isdigit() else -len(x)) for x in re.split('(\d+)', translate(s)) if x != '']
-        return res
-    def strip_to_int(s,prefix):
-        # strip the prefix
-        if prefix and s.startswith(prefix):
-            _,_,s = s.partition(prefix)
-        # extract the first int
-        val = split_by_int(s)[0]
-        return val
 
+    The search goes on from one directory to the next season/part, e.g. from
+    "Season 1/" to "Season 2/" or from "S01/CD2/" to "S02/CD1/". Only the
+    siblings of the directory and of its parent are looked at, and only if
+    they are named as seasons/parts.
+    '''
     if not os.path.exists(filepath):
         return []
 
-    import re
     pdir, basename = os.path.split(os.path.abspath(filepath))
     _, ext = os.path.splitext(basename)
+
+    results = []
+    for n in range(max_episode_dirs):
+        run = following_episodes(pdir, basename, ext)
+        if run is None:
+            # e.g. the seed is a directory, not listed as a file
+            break
+        results += [os.path.join(pdir,f) for f in run]
+
+        # go on only if the run ends with the directory
+        if (run or [basename])[-1] != episode_files(pdir, ext)[-1]:
+            break
+        last = (run or [basename])[-1]
+        pdir = next_episode_dir(pdir, ext)
+        if not pdir:
+            break
+        basename = episode_files(pdir, ext)[0]
+        if not starts_next_part(last, basename):
+            break
+        results.append(os.path.join(pdir,basename))
+    return results
+
+# bound of the directories crossed by find_more_episodes()
+max_episode_dirs = 32
+
+def episode_files(pdir, ext):
+    return [f for f in sorted_entries(pdir) if f.endswith(ext)]
+
+def following_episodes(pdir, basename, ext):
+    '''Return the files following basename in pdir, or None if basename isn't
+    one of the files with extension ext.
+    '''
     # basic candidate filtering
     # 1. extention
-    files = [f for f in os.listdir(pdir) if f.endswith(ext)]
+    files = episode_files(pdir, ext)
     # 2. remove previous episodes
-    files.sort(key=split_by_int)
+    if not basename in files:
+        return None
     del files[0:files.index(basename)]
 
     # not necessary to go further if no candidates
     if len(files) == 1:
         return []
 
-    # find the common prefix
-    i_break = 0
-    for i in range(min(len(files[0]),len(files[1]))):
-        if not files[0][i] == files[1][i]:
-           i_break = i
-           break
-    prefix = files[0][0:i_break]
+    prefix = common_prefix(files[0], files[1])
 
     # generate the list
     results = []
     for i,f in enumerate(files[1:]):
-        a, b = strip_to_int(f,prefix), strip_to_int(files[i],prefix)
-        if b>=0 and a-b>=1 and a-b<=2:
-            results.append(os.path.join(pdir,f))
+        if int_follows(files[i], f, prefix) or season_follows(files[i], f):
+            results.append(f)
         else:
             break
     return results
 
+def next_episode_dir(pdir, ext):
+    '''Return the directory holding the next season/part of pdir, or None.
+    '''
+    parent, name = os.path.split(pdir)
+    following = next_sibling_dir(parent, name)
+    if following:
+        # Season 2/ may be split into Season 2/CD1/ etc.
+        for d in [following] + [os.path.join(following,d) for d in sorted_entries(following, dirs=True) if is_part_dir(d)]:
+            if episode_files(d, ext):
+                return d
+        return None
+
+    # e.g. S01/CD2/ -> S02/CD1/
+    if not is_part_dir(name):
+        return None
+    grandparent, parent_name = os.path.split(parent)
+    following = next_sibling_dir(grandparent, parent_name)
+    if following:
+        for d in sorted_entries(following, dirs=True):
+            if skeleton(d) == skeleton(name) and episode_files(os.path.join(following,d), ext):
+                return os.path.join(following,d)
+    return None
+
+def next_sibling_dir(parent, name):
+    if parent == os.path.dirname(parent) or not is_part_dir(name):
+        # never go across the root
+        return None
+    dirs = sorted_entries(parent, dirs=True)
+    if not name in dirs:
+        return None
+    i = dirs.index(name)
+    if i+1 < len(dirs) and is_part_dir(dirs[i+1]) and int_follows(name, dirs[i+1], common_prefix(name, dirs[i+1])):
+        return os.path.join(parent, dirs[i+1])
+    return None
+
+def common_prefix(a, b):
+    i_break = 0
+    for i in range(min(len(a),len(b))):
+        if not a[i] == b[i]:
+           i_break = i
+           break
+    return a[0:i_break]
+
+def strip_to_int(s,prefix):
+    # strip the prefix
+    if prefix and s.startswith(prefix):
+        _,_,s = s.partition(prefix)
+    # extract the first int
+    val = episode_key(s)[0]
+    return val
+
+def int_follows(prev, cur, prefix):
+    '''True if the first int after prefix increases by 1 or 2.
+    '''
+    a, b = strip_to_int(cur,prefix), strip_to_int(prev,prefix)
+    return b>=0 and a-b>=1 and a-b<=2
+
+def starts_next_part(prev, cur):
+    '''True if cur, the first file of the next season/part directory, goes on
+    from prev, the last one of the current directory: by numbers (movie.cd1 ->
+    movie.cd2, S01E12 -> S02E01), or by restarting the episodes of the same
+    title (第十二集 -> 第一集).
+    '''
+    prefix = common_prefix(prev, cur)
+    if int_follows(prev, cur, prefix) or season_follows(prev, cur):
+        return True
+    return bool(prefix) and strip_to_int(prev,prefix) >= 1 and strip_to_int(cur,prefix) in (0, 1)
+
+def season_follows(prev, cur):
+    '''True if cur is the next episode of the same title by season/episode
+    tokens, e.g. S01E09 -> S01E10 or S01E12 -> S02E01.
+    '''
+    p, c = episode_tokens(prev), episode_tokens(cur)
+    if not p or not c or p[0] != c[0]:
+        return False
+    (s, e), (s2, e2) = p[1:], c[1:]
+    return s2 == s and 1 <= e2-e <= 2 or s2 == s+1 and e2 <= 1
+
+episode_numerals = dict((ord(c),d) for c,d in zip('零壹贰叁肆伍陆柒捌玖〇一二三四五六七八九','0123456789'*2))
+episode_re = re.compile('(\d+)')
+# S01E02, S01.EP02, 1x02 and 第1季第2集
+season_episode_re = re.compile('[Ss](\d{1,2})[ ._-]*[Ee][Pp]?(\d{1,3})'
+                               '|(?<!\d)(\d{1,2})[xX](\d{2,3})(?!\d)'
+                               '|第(\d+)季[ ._-]*第(\d+)[集话話]')
+
+def translate_numerals(s):
+    return fsdecode(s).translate(episode_numerals)
+
+def episode_key(s):
+    '''Split the name into ints and the lengths (negated) of the parts between
+    them, reading Chinese numerals as digits.
+    '''
+    return [(int(x) if x.isdigit() else -len(x)) for x in episode_re.split(translate_numerals(s)) if x != '']
+
+def episode_tokens(s):
+    '''Return (title, season, episode) of the name, or None.
+    '''
+    s = translate_numerals(s)
+    m = season_episode_re.search(s)
+    if not m:
+        return None
+    season, episode = [int(x) for x in m.groups() if x != None]
+    title = re.sub('[\W_]+', ' ', s[0:m.start()], flags=re.UNICODE).strip().lower()
+    return title, season, episode
+
+# Season 1, S01, CD1, Disc 1, Part 1, 第一季 etc.
+part_dir_re = re.compile('(?:^|[\W_])(?:season|series|s|cd|disc|disk|dvd|part|pt|vol)[ ._-]*\d+(?:$|[\W_])'
+                         '|第\d+[季部辑輯碟张張]', re.IGNORECASE|re.UNICODE)
+
+def is_part_dir(name):
+    return bool(part_dir_re.search(translate_numerals(name)))
+
+def skeleton(s):
+    # the name with every int replaced, e.g. CD# for CD1
+    return episode_re.sub('#', translate_numerals(s))
+
+# (pdir, dirs) -> (mtime, names sorted by episode_key)
+episode_index = {}
+
+def sorted_entries(pdir, dirs=False):
+    '''Return the files (or subdirectories) in pdir sorted by episode_key().
+    The result is kept in memory and in the cache dir until the mtime of pdir
+    changes, so that a huge directory is listed and sorted only once.
+    '''
+    mtime = os.path.getmtime(pdir)
+    cached = episode_index.get((pdir,dirs))
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    from cache import DiskCache
+    disk = DiskCache('episode', 16*1024*1024)
+    key = '{0}\n{1}'.format('dirs' if dirs else 'files', pdir)
+    stored = disk.get(key)
+    if stored and stored[0] == mtime:
+        names = stored[1]
+    else:
+        names = sorted(list_dirs(pdir) if dirs else list_files(pdir), key=episode_key)
+        disk.set(key, [mtime, names])
+    episode_index[(pdir,dirs)] = (mtime, names)
+    return names
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def list_files(pdir):
+    if scandir:
+        # the file type comes with the entry, no stat needed
+        return [e.name for e in scandir(pdir) if e.is_file()]
+    return os.listdir(pdir)
+
+def list_dirs(pdir):
+    if scandir:
+        return [e.name for e in scandir(pdir) if e.is_dir()]
+    return [d for d in os.listdir(pdir) if os.path.isdir(os.path.join(pdir,d))]
+
+class MountTable(object):
+    '''MountTable indexes /proc/self/mountinfo by mount point, so that the
+    mount of a path is found by a longest-prefix lookup without any stat.
+
+    The table is parsed once and reloaded only when the kernel reports a
+    change of the mounts, see proc(5).
+    '''
+    mountinfo = '/proc/self/mountinfo'
+
+    network_fs = ['afs', 'ceph', 'cifs', 'coda', 'glusterfs', 'ncpfs', 'nfs', 'nfs4', 'smb3', 'smbfs', '9p']
+    # FUSE filesystems are reported as fuse.<subtype>
+    network_fuse = ['sshfs', 'rclone', 's3fs', 'gcsfuse', 'curlftpfs', 'davfs2', 'glusterfs', 'cephfs', 'httpdirfs']
+
+    def __init__(self):
+        import threading
+        self.__lock = threading.Lock()
+        self.__mounts = {}
+        self.__fd = None
+        self.__poll = None
+
+    def lookup(self, path):
+        '''Return (mount point, filesystem type) of path.
+        '''
+        path = os.path.abspath(path)
+        with self.__lock:
+            if self.__changed():
+                self.__load()
+            mounts = self.__mounts
+        while not path in mounts:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return path, None
+            path = parent
+        return path, mounts[path]
+
+    def is_local(self, fstype):
+        if not fstype:
+            return True
+        if fstype.startswith('fuse.'):
+            return not fstype[len('fuse.'):] in self.network_fuse
+        return not fstype in self.network_fs
+
+    def __changed(self):
+        if self.__fd == None:
+            return True
+        # mountinfo is pollable: a change raises POLLERR|POLLPRI until reread
+        return self.__poll and bool(self.__poll.poll(0))
+
+    def __load(self):
+        import select
+        try:
+            if self.__fd == None:
+                self.__fd = os.open(self.mountinfo, os.O_RDONLY)
+                if hasattr(select, 'poll'):
+                    self.__poll = select.poll()
+                    self.__poll.register(self.__fd, select.POLLERR|select.POLLPRI)
+            os.lseek(self.__fd, 0, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(self.__fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError:
+            # not Linux: every file is taken as local
+            self.__fd = -1
+            return
+
+        self.__mounts = {}
+        for l in b''.join(chunks).splitlines():
+            # 36 35 98:0 /mnt1 /mnt2 rw,noatime master:1 - ext3 /dev/root rw
+            fields, _, fs = l.partition(b' - ')
+            fields, fs = fields.split(), fs.split()
+            if len(fields) < 5 or not fs:
+                continue
+            # spaces etc. are escaped as octal, e.g. \040
+            mountpoint = fsdecode(re.sub(br'\\([0-7]{3})', lambda m: bytes(bytearray([int(m.group(1), 8)])), fields[4]))
+            # a later mount shadows an earlier one on the same point
+            self.__mounts[mountpoint] = fsdecode(fs[0])
+
+mount_table = MountTable()
 
-# http://stackoverflow.com/questions/4453602/how-to-find-the-mountpoint-a-file-resides-on
 def find_mount_point(path):
-    path = os.path.abspath(path)
-    while not os.path.ismount(path):
-        path = os.path.dirname(path)
-    return path
+    return mount_table.lookup(path)[0]
 
-# TODO: cache for non-local files
-# http://stackoverflow.com/questions/11648822/how-to-determine-if-file-is-remote-in-python
 def is_file_local(path):
-    pseudo_fs = ['autofs', 'cgroup', 'devpts', 'devtmpfs', 'hugetlbfs', 'mqueue', 'proc', 'rootfs', 'sysfs']
-    network_fs = ['cifs', 'smbfs', 'nfs']
-        
-    mountpoint = find_mount_point(path)
-    with open('/proc/mounts') as f:
-        for l in f.read().splitlines():
-            words = l.split()
-            if words[1] == mountpoint:
-                # skip pseudo filesystem
-                if words[2] in pseudo_fs:
-                    continue
-                if words[2] in network_fs:
-                    return False
-                elif words[2] == 'fuse':
-                    # TODO
-                    pass
-        return True
+    _,fstype = mount_table.lookup(path)
+    return mount_table.is_local(fstype)
 
 if __name__ == '__main__':
     if len(sys.argv) != 1:
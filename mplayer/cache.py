@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010-2013 Bing Sun <subi.the.dream.walker@gmail.com>
+
+# A tiny persistent key-value store living in the cache dir.
+from __future__ import unicode_literals
+import os, stat, json, hashlib, tempfile, contextlib
+
+from globals import config, log_debug
+from aux import fsencode
+
+class DiskCache(object):
+    '''DiskCache stores JSON-serializable values under
+    $XDG_CACHE_HOME/mplayer-wrapper/<name>/, one file per key.
+
+    The modification time of an entry is bumped on every hit, so that the least
+    recently used entries are evicted first when the total size of the store
+    exceeds max_size (in bytes).
+
+    The total size is kept up to date in a stamp file, so a write costs O(1)
+    and the directory is only scanned when the store is over max_size. Then it
+    is shrunk to 3/4 of max_size, so that scans stay rare in a full store.
+    '''
+    stamp = '.size'
+
+    def __init__(self, name, max_size=4*1024*1024):
+        self.__dir = os.path.join(config.get_cache_dir(), name)
+        self.__max_size = max_size
+
+    def __entry(self, key):
+        return os.path.join(self.__dir, hashlib.md5(fsencode(key)).hexdigest())
+
+    def get(self, key, default=None):
+        path = self.__entry(key)
+        try:
+            with open(path, 'r') as f:
+                stored_key, value = json.load(f)
+            if stored_key != key:
+                return default
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return default
+        return value
+
+    def set(self, key, value):
+        path = self.__entry(key)
+        try:
+            if not os.path.exists(self.__dir):
+                os.makedirs(self.__dir, 0o700)
+            data = json.dumps([key, value]).encode('utf_8')
+            old_size = self.__size(path)
+            atomic_write(path, data)
+            self.__account(len(data) - old_size)
+        except (IOError, OSError, TypeError, ValueError) as e:
+            log_debug('Save {0} to cache failed because:\n  {1}'.format(key, e))
+
+    def remove(self, key):
+        path = self.__entry(key)
+        size = self.__size(path)
+        try:
+            os.unlink(path)
+            self.__account(-size)
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def __size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def __account(self, delta):
+        '''Add delta to the total size of the store, evicting entries if it
+        exceeds max_size.
+        '''
+        stamp = os.path.join(self.__dir, DiskCache.stamp)
+        try:
+            with open(stamp, 'r') as f:
+                total = int(f.read()) + delta
+        except (IOError, ValueError):
+            # a new store, or one from an older version
+            total = None
+        # the total may drift when processes write concurrently, it's
+        # corrected by every scan
+        if total is None or total < 0 or total > self.__max_size:
+            total = self.__evict()
+        atomic_write(stamp, str(total).encode('ascii'))
+
+    def __evict(self):
+        '''Scan the store, evict the least recently used entries if it exceeds
+        max_size and return its total size.
+        '''
+        entries = []
+        total = 0
+        for name in os.listdir(self.__dir):
+            if name == DiskCache.stamp:
+                continue
+            path = os.path.join(self.__dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        if total <= self.__max_size:
+            return total
+
+        # oldest first
+        entries.sort()
+        while entries and total > self.__max_size * 3 // 4:
+            _, size, path = entries.pop(0)
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+        return total
+
+def atomic_write(path, data):
+    '''Write data to a temporary file in the same directory and rename it to
+    path, so that readers never see a partially written file.
+    '''
+    with atomic_file(path) as f:
+        f.write(data)
+
+@contextlib.contextmanager
+def atomic_file(path):
+    '''Same as atomic_write() but yield the temporary file to write to. It
+    replaces path, keeping the permission bits of an existing file, only if
+    the block exits without error.
+    '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        if os.path.exists(path):
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+
+if __name__ == '__main__':
+    # a store of 20k entries, e.g. the shash of a large library, has to stay
+    # cheap to write and within its cap
+    import shutil, time
+    config.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        cache = DiskCache('selftest', 1024*1024)
+        start = time.time()
+        for i in range(20000):
+            cache.set('/videos/{0:05}.mkv'.format(i), 'f'*32)
+        elapsed = time.time() - start
+        total = sum(os.path.getsize(os.path.join(config.CACHE_DIR, 'selftest', n))
+                    for n in os.listdir(os.path.join(config.CACHE_DIR, 'selftest')) if n != DiskCache.stamp)
+        assert total <= 1024*1024, total
+        assert cache.get('/videos/19999.mkv') == 'f'*32
+        assert elapsed < 60, elapsed
+        print('ok: {0:.2f} ms per set, {1} bytes stored'.format(elapsed / 20 , total))
+    finally:
+        shutil.rmtree(config.CACHE_DIR)
@@ -5,21 +5,14 @@
 # Time-stamp: <2013-04-13 02:12:42 by subi>
 
 from __future__ import unicode_literals
+from __future__ import print_function
 
 def guess_utf8_lang(stream):
-    # TODO: prepare sample -> function
-    
-    # prepare the sample
-    # filter out ASCII as much as possible by the heuristic that a \x00-\x7F
-    # byte that following \x80-\xFF is not ASCII.
-    pattern = b'(?<![\x80-\xFE])' + Charset.re('ascii')
-    sample = filter_out(stream, pattern)
-
-    if len(sample)>2048:
-        sample = sample[0:2048]
+    return guess_sample_lang(prepare_sample(stream))
 
+def guess_sample_lang(sample):
     # the return value is (ascii, cjk, non-cjk)
-    if interprete_stream(sample, 'utf8_cjk')[1] > len(sample)*0.1:
+    if scan(sample, ['utf8_cjk'])['utf8_cjk'][1] > len(sample)*0.1:
         return 'chn'
     else:
         # TODO: what about other languages?
@@ -41,6 +34,56 @@ def guess_locale_and_convert(stream):
         
     return enc,lang,stream
 
+def guess_file_locale(f, naive=True, chunk_size=64*1024):
+    '''Same as guess_locale() but read the file object f chunk by chunk, and
+    stop reading as soon as the sample is filled.
+    '''
+    # long enough for any BOM
+    chunk = f.read(max(chunk_size, 4))
+    for sig,enc in Charset.bom:
+        if chunk.startswith(sig):
+            return enc,len(sig)
+
+    sampler = Sampler()
+    while chunk and not sampler.feed(chunk):
+        chunk = f.read(chunk_size)
+    return guess_sample_locale(sampler.sample(), naive)
+
+def convert_file(src, dst, chunk_size=64*1024):
+    '''Same as guess_locale_and_convert() but transcode the seekable file
+    object src into the file object dst chunk by chunk, so that the memory
+    used is bounded whatever the size of src.
+
+    Return: (enc, lang)
+    '''
+    import codecs
+    start = src.tell()
+    enc,lang = guess_file_locale(src, chunk_size=chunk_size)
+    src.seek(start)
+
+    if isinstance(lang,int):
+        src.read(lang)
+        lang = 'und'
+
+    decoder = None
+    if not enc in ['utf_8', 'ascii']:
+        decoder = codecs.getincrementaldecoder(enc)('ignore')
+
+    sampler = Sampler()
+    while True:
+        chunk = src.read(chunk_size)
+        data = decoder.decode(chunk, not chunk).encode('utf_8') if decoder else chunk
+        if data:
+            dst.write(data)
+            if lang == 'und':
+                sampler.feed(data)
+        if not chunk:
+            break
+
+    if lang == 'und':
+        lang = guess_sample_lang(sampler.sample())
+    return enc,lang
+
 # implementation
 import re
 
@@ -113,12 +156,30 @@ class Charset(object):
                          b'\xEF[\xBC-\xBE][\x80-\xBF]|\xEF\xBF[\x80-\xAF]',         # EFBC80-EFBFAF
                          )
     
+    __re = {}
+    __scanners = {}
+
     @staticmethod
     def re(enc, with_ascii=True):
-        if with_ascii and not enc == 'ascii':
-            return b'|'.join(Charset.codec['ascii'] + Charset.codec[enc])
-        else:
-            return b'|'.join(Charset.codec[enc])
+        key = (enc, with_ascii and not enc == 'ascii')
+        if not key in Charset.__re:
+            if key[1]:
+                Charset.__re[key] = b'|'.join(Charset.codec['ascii'] + Charset.codec[enc])
+            else:
+                Charset.__re[key] = b'|'.join(Charset.codec[enc])
+        return Charset.__re[key]
+
+    @staticmethod
+    def scanner(enc):
+        '''Return the compiled regex that matches either a standalone ASCII
+        byte (captured) or a code point of enc.
+        '''
+        if not enc in Charset.__scanners:
+            Charset.__scanners[enc] = re.compile(b'(' + Charset.re('ascii') + b')|' + Charset.re(enc, with_ascii=False))
+        return Charset.__scanners[enc]
+
+# a byte that is not ASCII or follows \x80-\xFE, see prepare_sample()
+sample_re = re.compile(b'(?<=[\x80-\xFE])[\x00-\xFF]|[^\x09\x0A\x0D\x20-\x7E]')
 
 def filter_in(stream, regex):
     # find matches and join them
@@ -140,24 +201,198 @@ def interprete_stream(stream, enc):
 
     return len(standalone_ascii), len(interpretable)-len(standalone_ascii), len(stream)-len(interpretable)
 
-def guess_locale(stream, naive=True):
+def prepare_sample(stream, size=2048):
+    '''Filter out ASCII as much as possible by the heuristic that a \x00-\x7F
+    byte that following \x80-\xFF is not ASCII, and return the first size
+    bytes left.
+    '''
+    sampler = Sampler(size)
+    sampler.feed(stream)
+    return sampler.sample()
+
+class Sampler(object):
+    '''Sampler does prepare_sample() incrementally on a stream fed chunk by
+    chunk. Every chunk is filtered only as far as needed.
+    '''
+    def __init__(self, size=2048):
+        self.size = size
+        self.__kept = []
+        self.__length = 0
+        self.__last = b''
+
+    def feed(self, chunk):
+        '''Return True when the sample is filled.
+        '''
+        if self.__length >= self.size:
+            return True
+
+        # prepend the last byte of the previous chunk for the lookbehind
+        stream = self.__last + chunk if self.__last else chunk
+        step = max(self.size*2, 4096)
+        for pos in range(len(self.__last), len(stream), step):
+            # the lookbehind sees the byte before pos as well
+            kept = b''.join(sample_re.findall(stream, pos, pos+step))
+            self.__kept.append(kept)
+            self.__length += len(kept)
+            if self.__length >= self.size:
+                break
+        self.__last = chunk[-1:]
+        return self.__length >= self.size
+
+    def sample(self):
+        return b''.join(self.__kept)[0:self.size]
+
+def scan(sample, encodings):
+    '''Interprete the sample by each of the encodings. The result is the same
+    as interprete_stream() but every encoding costs only two passes of a
+    precompiled regex.
+
+    Return: {enc: (#ASCII, #ENC, #OTHER)}
+    '''
+    counts = {}
+    for enc in encodings:
+        scanner = Charset.scanner(enc)
+        other = uninterpretable(sample, enc)
+        # the captured group is empty unless standalone ASCII matches
+        standalone_ascii = len(b''.join(scanner.findall(sample)))
+        counts[enc] = (standalone_ascii, len(sample)-standalone_ascii-other, other)
+    return counts
+
+def uninterpretable(sample, enc):
+    '''Return #OTHER of scan() in a single pass.
+    '''
+    return len(Charset.scanner(enc).sub(b'', sample))
+
+# Vectorized implementation for batch work, e.g. --benchmark. NumPy is only
+# imported when the 'numpy' engine is asked for.
+numpy = None
+ascii_table = None
+
+def load_numpy():
+    global numpy, ascii_table
+    if numpy is None:
+        import numpy as np
+        ascii_table = np.array([0x20 <= i <= 0x7E or i in (0x09, 0x0A, 0x0D)
+                                for i in range(256)])
+        numpy = np
+
+__tables = {}
+
+def code_point_ranges(enc):
+    '''Parse the patterns of enc, made of literal bytes and classes like
+    [\x40-\x7E\x80-\xFE] optionally repeated like {2}, and yield the bytes
+    allowed at each position of every alternative.
+    '''
+    for alternative in b'|'.join(Charset.codec[enc]).split(b'|'):
+        pattern = bytearray(alternative)
+        positions = []
+        i = 0
+        while i < len(pattern):
+            if pattern[i] == ord('['):
+                end = pattern.index(ord(']'), i)
+                members = pattern[i+1:end]
+                allowed = set()
+                j = 0
+                while j < len(members):
+                    if j+2 < len(members) and members[j+1] == ord('-'):
+                        allowed.update(range(members[j], members[j+2]+1))
+                        j += 3
+                    else:
+                        allowed.add(members[j])
+                        j += 1
+                positions.append(sorted(allowed))
+            elif pattern[i] == ord('{'):
+                end = pattern.index(ord('}'), i)
+                positions.extend(positions[-1:] * (int(bytes(pattern[i+1:end])) - 1))
+            else:
+                end = i
+                positions.append([pattern[i]])
+            i = end + 1
+        yield positions
+
+def code_point_table(enc):
+    '''Return an array indexed by the first two bytes (as a 16-bit integer)
+    giving the length of the code point of enc they start, or 0.
+
+    Any byte after the second is expected to be \x80-\xBF, which holds for all
+    multibyte encodings scored by guess_locale().
+    '''
+    if not enc in __tables:
+        load_numpy()
+        table = numpy.zeros((256, 256), numpy.uint8)
+        # the regex takes the first alternative that matches
+        for positions in reversed(list(code_point_ranges(enc))):
+            table[numpy.ix_(positions[0], positions[1])] = len(positions)
+        __tables[enc] = table.ravel()
+    return __tables[enc]
+
+def vectorized_prepare_sample(stream, size=2048):
+    '''Same as prepare_sample().
+    '''
+    load_numpy()
+    data = numpy.frombuffer(stream, numpy.uint8)
+    sample = []
+    length = 0
+    chunk = max(size*2, 4096)
+    for pos in range(0, len(data), chunk):
+        block = data[pos:pos+chunk]
+        # a byte following \x80-\xFE is kept, the first one looks back at pos-1
+        prev = data[pos-1:pos-1+len(block)] if pos else numpy.append([0], block[:-1])
+        kept = block[~ascii_table[block] | ((prev >= 0x80) & (prev <= 0xFE))]
+        sample.append(kept.tobytes())
+        length += len(kept)
+        if length >= size:
+            break
+    return b''.join(sample)[0:size]
+
+def vectorized_uninterpretable(sample, enc):
+    '''Same as uninterpretable().
+
+    The regex takes a code point wherever one starts unless the byte is
+    already the trail of the previous one. In a run of consecutive starts it
+    thus takes every second one, while in UTF-8 a start never falls inside
+    another code point.
+    '''
+    n = len(sample)
+    if n == 0:
+        return 0
+    load_numpy()
+    data = numpy.frombuffer(sample + b'\x00\x00\x00', numpy.uint8).astype(numpy.intp)
+    length = code_point_table(enc)[data[:-1]<<8 | data[1:]][:n]
+
+    cont = (data >= 0x80) & (data <= 0xBF)
+    valid = (length == 2) | ((length == 3) & cont[2:n+2]) | \
+            ((length == 4) & cont[2:n+2] & cont[3:n+3])
+
+    index = numpy.arange(n)
+    run_start = valid & ~numpy.append([False], valid[:-1])
+    first = numpy.maximum.accumulate(numpy.where(run_start, index, 0))
+    start = valid & ((index - first) % 2 == 0)
+
+    ascii = ascii_table[data[:n]]
+    # ASCII bytes can be the trail of a double-byte code point
+    trail = numpy.append([False], start[:-1])
+    return n - int(length[start].sum()) - int((ascii & ~trail).sum())
+
+# name -> (sampler, counter, builder of the per-encoding tables)
+engines = {'python': (prepare_sample, uninterpretable, Charset.scanner),
+           'numpy': (vectorized_prepare_sample, vectorized_uninterpretable, code_point_table)}
+
+def guess_locale(stream, naive=True, engine=None):
     # detect if there is BOM
     for sig,enc in Charset.bom:
         if stream.startswith(sig):
             return enc,len(sig)
-        
-    # prepare the sample
-    # filter out ASCII as much as possible by the heuristic that a \x00-\x7F
-    # byte that following \x80-\xFF is not ASCII.
-    pattern = b'(?<![\x80-\xFE])' + Charset.re('ascii')
-    sample = filter_out(stream, pattern)
-    
-    if len(sample)>2048:
-        sample = sample[0:2048]
+
+    sampler = engines[engine or 'python'][0]
+    return guess_sample_locale(sampler(stream), naive, engine)
+
+def guess_sample_locale(sample, naive=True, engine=None):
+    counter = engines[engine or 'python'][1]
 
     # true when having less than 0.5% (~10) bytes cannot be interpreted
     threshold = int(len(sample) * .005)
-    if interprete_stream(sample, 'utf_8')[2] <= threshold:
+    if counter(sample, 'utf_8') <= threshold:
         # TODO: guess_lang here
         return 'utf_8','und'
     elif naive:
@@ -167,7 +402,7 @@ def guess_locale(stream, naive=True):
         # The priority is GB2312>BIG5>GBK when the bytes can interpreted by at
         # least two of them. If this is not you want, please set naive=False.
         for enc,lang in [('gb2312','chs'), ('big5','cht'), ('gbk','cht')]:
-            if interprete_stream(sample, enc)[2] <= threshold:
+            if counter(sample, enc) <= threshold:
                return enc,lang 
     else:
         # GBK and BIG5 share most code points and hence it's almost impossible
@@ -185,9 +420,43 @@ def guess_locale(stream, naive=True):
             return 'big5','cht'
     return 'ascii','eng'
 
+def benchmark(paths, repeat=10):
+    '''Run guess_locale() of every engine over the same corpus and compare
+    the time and the guesses.
+    '''
+    import time
+    corpus = []
+    for path in paths:
+        with open(path,'rb') as f:
+            corpus.append(f.read())
+
+    guesses = {}
+    for engine in sorted(engines):
+        # the compiled patterns or tables are built once per process
+        start = time.time()
+        try:
+            for enc in ['utf_8', 'gb2312', 'big5', 'gbk']:
+                engines[engine][2](enc)
+        except ImportError:
+            print('{0:8} not available'.format(engine))
+            continue
+        setup = time.time() - start
+        start = time.time()
+        for i in range(repeat):
+            guesses[engine] = [guess_locale(s, engine=engine) for s in corpus]
+        print('{0:8} {1:8.3f} ms/file, {2:8.3f} ms to build the tables'.format(
+            engine, (time.time()-start)*1000/repeat/max(len(corpus),1), setup*1000))
+    if len(guesses) == 2 and guesses['numpy'] != guesses['python']:
+        print('Engines disagree on:')
+        for path, a, b in zip(paths, guesses['python'], guesses['numpy']):
+            if a != b:
+                print(' ', path, a, b)
+
 if __name__ == '__main__':
     import sys
-    if len(sys.argv) != 1:
+    if len(sys.argv) > 2 and sys.argv[1] == '--benchmark':
+        benchmark(sys.argv[2:])
+    elif len(sys.argv) != 1:
         for path in sys.argv[1:]:
             with open(path,'rb') as f:
                 enc, lang, stream = guess_locale_and_convert(f.read())
@@ -33,26 +33,124 @@ def apply_geometry_fix(w,h,DAR_advice,DAR_force=None):
     return DAR, PAR, args + expand_video(DAR)
 
 # implementation
-import subprocess
+import subprocess, re, json
 from fractions import Fraction
 
+from globals import *
 from aux import which
 
 def check_screen_dim():
-    '''Select the maximal available screen dimension.
+    '''Return the dimension of the screen on which the video is shown. In
+    order of precedence, it is given by
+    1. the -screenw and -screenh options,
+    2. config.SCREEN_DIM or $MPLAYER_SCREEN (e.g. 1920x1080), for headless
+       boxes or to skip the probing,
+    3. the monitor chosen by -xineramascreen, or the primary monitor.
     '''
-    dim = (640,480)
-    if which('randr'):
-        for l in subprocess.check_output(['randr']).splitlines():
-            if l.startswith('*'): # xrandr 1.1
-                _,w,_,h = l.split()
-            elif '*' in l:        # xrandr 1.2 and above
-                w,h = l.split()[0].split('x')
-            else:
-                continue
-            if w > dim[0]:
-                dim = (w,h)
-    return dim
+    args = config.CMDLINE_ARGS
+    def arg(name):
+        return args[args.index(name)+1] if name in args[:-1] else None
+
+    if arg('-screenw') and arg('-screenh'):
+        return int(arg('-screenw')), int(arg('-screenh'))
+
+    override = config.SCREEN_DIM or os.environ.get('MPLAYER_SCREEN')
+    if override:
+        if isinstance(override, tuple):
+            return override
+        m = screen_dim_re.match(override.strip())
+        if m:
+            return int(m.group(1)), int(m.group(2))
+        log_info('Ignored the malformed screen dimension {0}, expected e.g. 1920x1080.'.format(override))
+
+    monitors = screen_topology()
+    if not monitors:
+        return (640,480)
+    # the Xinerama screens of RandR start with the primary monitor
+    n = int(arg('-xineramascreen') or 0)
+    m = monitors[n] if 0 <= n < len(monitors) else monitors[0]
+    return m['width'], m['height']
+
+screen_dim_re = re.compile('^(\d+)[xX](\d+)$')
+
+# DISPLAY and connector states -> monitors
+topologies = {}
+
+def screen_topology():
+    '''Return the active monitors of $DISPLAY, the primary one first.
+
+    xrandr is run once per X session: the result is kept in memory and in
+    the runtime dir, and is valid as long as no connector is plugged or
+    unplugged.
+    '''
+    display = os.environ.get('DISPLAY')
+    if not display:
+        return []
+    key = '{0}\n{1}'.format(display, connector_states())
+    if key in topologies:
+        return topologies[key]
+
+    # the runtime dir lives as long as the login session unless it is a
+    # temporary one of our own
+    runtime_dir = config.get_runtime_dir()
+    session_file = None if config.TEMP_RUNTIME_DIR else os.path.join(runtime_dir, 'mplayer-wrapper-screens')
+    stored = {}
+    if session_file:
+        try:
+            with open(session_file) as f:
+                stored = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    if key in stored:
+        monitors = stored[key]
+    else:
+        monitors = probe_xrandr()
+        if monitors and session_file:
+            from cache import atomic_write
+            stored[key] = monitors
+            try:
+                atomic_write(session_file, json.dumps(stored).encode('utf_8'))
+            except (IOError, OSError) as e:
+                log_debug('Save the screen topology failed because:\n  {0}'.format(e))
+    topologies[key] = monitors
+    return monitors
+
+def connector_states():
+    import glob
+    states = []
+    for path in sorted(glob.glob('/sys/class/drm/card*-*/status')):
+        try:
+            with open(path) as f:
+                states.append('{0}={1}'.format(os.path.basename(os.path.dirname(path)), f.read().strip()))
+        except IOError:
+            pass
+    return ' '.join(states)
+
+# HDMI-1 connected primary 1920x1080+0+0 (normal left inverted ...) 527mm x 296mm
+xrandr_output_re = re.compile('^(\S+) connected( primary)? (\d+)x(\d+)\+(\d+)\+(\d+)')
+
+def probe_xrandr():
+    if not which('xrandr'):
+        return []
+    log_debug('Probing the screen topology by xrandr...')
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            output = subprocess.check_output(['xrandr', '--query'], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log_debug('xrandr failed because:\n  {0}'.format(e))
+        return []
+
+    monitors = []
+    for l in output.decode('utf_8', 'ignore').splitlines():
+        m = xrandr_output_re.match(l)
+        if m:
+            name, primary, w, h, x, y = m.groups()
+            monitors.append({'name': name, 'primary': bool(primary),
+                             'width': int(w), 'height': int(h), 'x': int(x), 'y': int(y)})
+    # stable: the others stay in the order of xrandr
+    monitors.sort(key=lambda m: not m['primary'])
+    return monitors
 
 def auto_adjust_DAR(w,h,DAR):
     '''Determine a reasonable display aspect ratio.
@@ -18,9 +18,35 @@ class config(object):
     CMDLINE_ASPECT=None
     CMDLINE_ARGS=[]
     VIDEO_EXTRA_ARGS=[]
+
+    # refresh rate (Hz) of the status line, 0 for no limit
+    STATUS_REFRESH_RATE=10
+
+    # maximal concurrent requests for subtitles
+    MAX_REQUESTS=4
+    # give up fetching subtitles after FETCH_DEADLINE seconds; query a second
+    # mirror if the first one doesn't answer in HEDGE_DELAY seconds (0 to
+    # disable)
+    FETCH_DEADLINE=90
+    HEDGE_DELAY=3.0
+    # fetched subtitles are cached by the video hash; an empty answer expires
+    # after NO_SUBTITLE_TTL seconds
+    SUBTITLE_CACHE_SIZE=64*1024*1024
+    # limits for the subtitles in an answer
+    MAX_SUBTITLE_SIZE=4*1024*1024
+    MAX_SUBTITLE_COUNT=16
+    NO_SUBTITLE_TTL=24*3600
+
+    # number of following playlist entries prepared in the background
+    PLAYLIST_LOOKAHEAD=1
+
+    # screen dimension, e.g. (1920,1080), instead of probing by xrandr; may
+    # also be given by $MPLAYER_SCREEN=1920x1080
+    SCREEN_DIM=None
     
     CACHE_DIR=None
     RUNTIME_DIR=None
+    TEMP_RUNTIME_DIR=None
 
     @staticmethod
     def get_runtime_dir():
@@ -29,10 +55,18 @@ class config(object):
             if not runtime_home:
                 import tempfile, atexit
                 runtime_home = tempfile.mkdtemp()
-                atexit.register(lambda d: os.rmdir(d), runtime_home)
+                config.TEMP_RUNTIME_DIR = runtime_home
+                atexit.register(config.clean_runtime_dir)
             config.RUNTIME_DIR = runtime_home
         return config.RUNTIME_DIR
 
+    @staticmethod
+    def clean_runtime_dir():
+        # remove the runtime dir if it is created by us
+        if config.TEMP_RUNTIME_DIR:
+            os.rmdir(config.TEMP_RUNTIME_DIR)
+            config.TEMP_RUNTIME_DIR = None
+
     @staticmethod
     def get_cache_dir():
         if not config.CACHE_DIR:
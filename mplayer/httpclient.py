@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010-2013 Bing Sun <subi.the.dream.walker@gmail.com>
+
+# A small HTTP client keeping persistent connections and mirror statistics.
+from __future__ import unicode_literals
+import httplib, socket, threading, time, urlparse, sys
+
+from globals import *
+from cache import DiskCache
+
+class HTTPClient(object):
+    '''HTTPClient keeps idle connections per (scheme, host) for reuse, and
+    records the latency and failures of every host in the cache dir so that
+    rank() can put the fastest healthy mirrors first.
+    '''
+    # exponentially weighted moving average
+    alpha = 0.3
+    # latency assumed for hosts never tried
+    default_latency = 2.0
+
+    def __init__(self, name, timeout=30):
+        self.__name = name
+        self.__timeout = timeout
+        self.__idle = {}
+        self.__lock = threading.Lock()
+        self.__stats = None
+
+    def request(self, url, data=None, headers={}, reader=None):
+        '''Send a request (POST if data is given) and return (status, body).
+        Raise on network errors.
+
+        If reader is given, it is called with the response as a file object and
+        its result is returned in place of the body, so that the body can be
+        consumed as a stream. Whatever left unread is discarded.
+        '''
+        u = urlparse.urlsplit(url)
+        mirror = '{0}://{1}'.format(u.scheme, u.netloc)
+        # httplib of python 2 fails to append a UTF-8 body to a unicode head
+        host = native(u.netloc)
+        path = native(u.path + ('?' + u.query if u.query else ''))
+
+        start = time.time()
+        try:
+            conn, reused = self.__checkout(u.scheme, host)
+            try:
+                status, body = self.__send(conn, path, data, headers, reader)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused:
+                    raise
+                # the server may have closed the idle connection
+                conn, reused = self.__connect(u.scheme, host), False
+                status, body = self.__send(conn, path, data, headers, reader)
+        except (httplib.HTTPException, socket.error):
+            # only network errors tell about the mirror
+            self.__record(mirror, None)
+            raise
+
+        self.__record(mirror, time.time()-start if status < 500 else None)
+        self.__checkin(u.scheme, u.netloc, conn)
+        return status, body
+
+    def rank(self, mirrors):
+        '''Sort the mirrors (like 'http://host') by health and latency.
+        '''
+        stats = self.__load_stats()
+        now = time.time()
+        def key(mirror):
+            s = stats.get(mirror, {})
+            failures = s.get('failures', 0)
+            # back off exponentially from hosts failing in a row
+            unhealthy = failures and now - s.get('last_failure', 0) < 60 * 2**min(failures,6)
+            return (bool(unhealthy), failures, s.get('latency', self.default_latency))
+        return sorted(mirrors, key=key)
+
+    def __send(self, conn, path, data, headers, reader):
+        conn.request(native('POST' if data != None else 'GET'), path, data, headers)
+        response = conn.getresponse()
+        try:
+            if reader:
+                body = reader(response)
+                while response.read(64*1024):
+                    pass
+            else:
+                body = response.read()
+        except:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        return response.status, body
+
+    def __connect(self, scheme, host):
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.__timeout)
+        return httplib.HTTPConnection(host, timeout=self.__timeout)
+
+    def __checkout(self, scheme, host):
+        with self.__lock:
+            idle = self.__idle.get((scheme,host))
+            if idle:
+                return idle.pop(), True
+        return self.__connect(scheme, host), False
+
+    def __checkin(self, scheme, host, conn):
+        # a closed connection has no socket
+        if conn.sock:
+            with self.__lock:
+                self.__idle.setdefault((scheme,host), []).append(conn)
+
+    def __load_stats(self):
+        with self.__lock:
+            if self.__stats == None:
+                self.__stats = DiskCache('http').get(self.__name, {})
+            return self.__stats
+
+    def __record(self, mirror, latency):
+        stats = self.__load_stats()
+        with self.__lock:
+            s = stats.setdefault(mirror, {})
+            if latency == None:
+                s['failures'] = s.get('failures', 0) + 1
+                s['last_failure'] = time.time()
+            else:
+                s['failures'] = 0
+                s['latency'] = latency if not 'latency' in s else \
+                               self.alpha*latency + (1-self.alpha)*s['latency']
+            snapshot = dict(stats)
+        log_debug('Mirror {0}: {1}'.format(mirror, s))
+        DiskCache('http').set(self.__name, snapshot)
+
+def native(s):
+    '''Return s as the native str, which httplib expects for the request
+    line and headers.
+    '''
+    if sys.hexversion < 0x03000000 and isinstance(s, unicode):
+        s = s.encode('utf_8')
+    return s
+
+if __name__ == '__main__':
+    # check against a stand-in server that a UTF-8 body, e.g. the pathinfo of
+    # a video with a non-ASCII name, is sent untouched
+    import BaseHTTPServer, urllib
+    class EchoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), EchoHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    pathinfo = 'D:\\十二国记\\第一集.avi'.encode('utf_8')
+    url = 'http://127.0.0.1:{0}/api/{1}'.format(server.server_port, urllib.quote(pathinfo))
+    client = HTTPClient('selftest')
+    for i in range(2):
+        # the second request reuses the connection
+        assert client.request(url, pathinfo, {b'Content-Type': b'text/plain'}) == (200, pathinfo)
+    server.shutdown()
+    print('ok')
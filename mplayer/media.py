@@ -5,7 +5,7 @@
 # Time-stamp: <2014-03-08 21:05:44 by subi>
 
 from __future__ import unicode_literals
-import hashlib
+import threading
 from collections import defaultdict
 
 from globals import *
@@ -14,27 +14,47 @@ import subtitle
 
 class Media(object):
     def play(self):
-        self.prepare_mplayer_args()
+        if not self.__prepared:
+            self.prepare_mplayer_args()
         singleton.get_mplayer().play(self.args)
+        if self.__info['video'] and not config.DRY_RUN:
+            from telemetry import save_metrics
+            save_metrics(self.__info['abspath'] or self.__info['path'], singleton.get_mplayer().last_stats)
+
+    def is_prepared(self):
+        return self.__prepared
+
+    def is_video(self):
+        return self.__info['video']
 
     def fetch_remote_subtitles(self, sub_savedir=None):
         info = self.__info
-        subtitle.fetch_and_save_subtitle(info['abspath'], info['shash'], sub_savedir)
+        return subtitle.fetch_and_save_subtitle(info['abspath'], info['shash'], sub_savedir, osd=False)
         
-    def fetch_if_no_local_subtitles(self, sub_savedir=None):
+    def fetch_if_no_local_subtitles(self, sub_savedir=None, preload=False):
+        '''Fetch subtitles if there are no usable local ones. When preload is
+        True the media is not being played yet, so the subtitles are only saved
+        and will be loaded by a later call.
+        '''
         info = self.__info
-        if not info['subtitle']:
-            # if parse_local_subtitles() not done
-            info['subtitle'] = defaultdict(bool)
-
-        if info['subtitle']['embed'] and set(info['subtitle']['embed'])&{'chs','cht','chn','chi','zh','tw','hk'}:
-            # have Chinese text subtitles
-            pass
-        elif info['subtitle']['external']:
-            # TODO: language?
-            pass
-        else:
-            info['subtitle']['remote'] = subtitle.fetch_and_save_subtitle(info['abspath'], info['shash'], sub_savedir)
+        with self.__fetch_lock:
+            if not info['subtitle']:
+                # if parse_local_subtitles() not done
+                info['subtitle'] = defaultdict(bool)
+
+            if 'remote' in info['subtitle']:
+                # already fetched
+                pass
+            elif info['subtitle']['embed'] and set(info['subtitle']['embed'])&{'chs','cht','chn','chi','zh','tw','hk'}:
+                # have Chinese text subtitles
+                pass
+            elif info['subtitle']['external']:
+                # TODO: language?
+                pass
+            else:
+                info['subtitle']['remote'] = subtitle.fetch_and_save_subtitle(info['abspath'], info['shash'], sub_savedir, osd=not preload)
+
+        if not preload and 'remote' in info['subtitle']:
             for s in info['subtitle']['remote']:
                 singleton.get_mplayer().send('sub_load "{0}"'.format(s))
             singleton.get_mplayer().send('sub_file 0')
@@ -44,7 +64,7 @@ class Media(object):
         self.__raw_info['mplayer'] = defaultdict(list)
         raw = self.__raw_info['mplayer']
 
-        for l in singleton.get_mplayer().identify(self.args).splitlines():
+        for l in self.__identify().splitlines():
             k,_,v = l.partition('=')
             raw[k].append(v)
             
@@ -73,6 +93,31 @@ class Media(object):
 
         # append global arguments from command line
         self.args += config.CMDLINE_ARGS
+        self.__prepared = True
+
+    def __identify(self):
+        '''midentify the media, or reuse the output of a previous run when
+        neither the media nor its directory (think of newly saved subtitles)
+        has been modified since.
+        '''
+        info = self.__info
+        if not info['abspath']:
+            return singleton.get_mplayer().identify(self.args)
+
+        from cache import DiskCache
+        from aux import file_identity
+        key = '\n'.join([info['abspath'], file_identity(info['abspath']),
+                          repr(os.path.getmtime(os.path.dirname(info['abspath']))),
+                          info['shash'] or '', ' '.join(self.args[1:])])
+        cache = DiskCache('identify')
+        output = cache.get(key)
+        if output is None:
+            output = singleton.get_mplayer().identify(self.args)
+            if output:
+                cache.set(key, output)
+        else:
+            log_debug('Media.__identify() ---> Reuse cached info of {0}'.format(info['abspath']))
+        return output
 
     def parse_local_subtitles(self):
         info = self.__info
@@ -88,16 +133,13 @@ class Media(object):
         if raw['ID_FILE_SUB_ID']:
             info['subtitle']['external'] = raw['ID_FILE_SUB_FILENAME']
             log_debug('Converting the external subtitles to UTF-8...')
-            from charset import guess_locale_and_convert
-            for subfile in raw['ID_FILE_SUB_FILENAME']:
-                # open in binary mode because we don't know the encoding
-                with open(subfile,'r+b') as f:
-                    s = f.read()
-                    enc,_,s = guess_locale_and_convert(s)
-                    if not enc in ['utf_8','ascii']:
-                        f.seek(0)
-                        f.write(s)
-            self.add_arg('-subcp utf8')
+            encodings = set(subtitle.convert_to_utf8(subfile) for subfile in raw['ID_FILE_SUB_FILENAME'])
+            if len(encodings) == 1 and not None in encodings:
+                # some may be left unconverted, e.g. in a read-only directory
+                self.add_arg('-subcp {0}'.format(iconv_name(encodings.pop())))
+            else:
+                log_info('The external subtitles are in different encodings: {0}'.format(
+                    ', '.join(e or 'unknown' for e in encodings)))
         if raw['ID_VOBSUB_ID']:
             info['subtitle']['vobsub'] = True
             unrar = which('unrar')
@@ -112,6 +154,8 @@ class Media(object):
 
     def __init__(self,path):
         self.args = [path]
+        self.__prepared = False
+        self.__fetch_lock = threading.Lock()
         
         self.__info = defaultdict(bool)
         self.__raw_info = defaultdict(bool)
@@ -123,10 +167,7 @@ class Media(object):
         # basic info
         info = self.__info
         info['abspath'] = os.path.abspath(info['path'])
-        sz = os.path.getsize(info['path'])
-        if sz>8192:
-            with open(info['path'],'rb') as f:
-                info['shash'] = ';'.join([(f.seek(s), hashlib.md5(f.read(4096)).hexdigest())[1] for s in (lambda l:[4096, l/3*2, l/3, l-8192])(sz)])
+        info['shash'] = subtitle.shooter_hash(info['path'])
 
     def __del__(self):
         if not config.DEBUG:
@@ -142,3 +183,11 @@ class Media(object):
                                      '{0.numerator}:{0.denominator}'.format(info['DAR'])))
         log_debug('\n'.join(log_items))
 
+
+def iconv_name(enc):
+    '''Return the name by which iconv, i.e. -subcp, knows the Python codec.
+    '''
+    if enc == 'utf_8':
+        return 'utf8'
+    # e.g. utf_16_le -> UTF-16LE
+    return enc.replace('_16_', '-16').replace('_32_', '-32').upper()
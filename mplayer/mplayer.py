@@ -6,221 +6,296 @@
 
 from __future__ import unicode_literals
 
-from aux import which, fsencode, fsdecode
+from aux import which, fsencode, fsdecode, file_identity
+from cache import DiskCache, atomic_write
 from globals import *
 
-import subprocess,hashlib,json
+import subprocess,hashlib,marshal,threading
 try:
     from subprocess import DEVNULL
 except ImportError:
     DEVNULL = open(os.devnull, 'wb')
 from collections import defaultdict
 
-class PlayerBackend(object):
-    # und, mpv, mp, mp2
-    backend = 'und'
-    
-    @classmethod
-    def get_backend(cls):
-        return cls.backend
-
-    def __init__(self):
-        self.__path = None
-        self.__context = defaultlist(bool)
-        self.__detect_backend()
-
-    def __detect_backend(self):
-        check_list = ['/opt/bin/mpv','/usr/local/bin/mpv','/usr/bin/mpv',
-                      '/opt/bin/mplayer','/usr/local/bin/mplayer','/usr/bin/mplayer']
-
-        for p in check_list:
-            if which(p):
-                self.__path = p
-                break
-
-    def __init_context(self):
-        # no mplayer binary presents
-        if not self.__path:
-            return
-
-        cache_file = os.path.join(config.get_cache_dir(), 'info')
-        try:
-            self.__load_context(cache_file)
-        except StandardError as e:
-            log_debug('Load context from {} failed because: \n  {}'.format(cache_file, e))
-
-        if not self.__context['option']:
-            self.__rebuild_context()
-            
-            try:
-                if not os.path.exists(config.get_cache_dir()):
-                    os.mkdir(config.get_cache_dir(),0o700)
-                with open(cache_file,'w') as f:
-                    json.dump(self, f)
-            except StandardError as e:
-                log_debug('Save context to {} failed because:\n  {}'.format(cache_file, e))
-
-    def __load_context(self, cache_file):
-        with open(self['path'],'rb') as f:
-            self['hash'] = hashlib.md5(f.read()).hexdigest()
-
-        with open(cache_file,'r') as f:
-            cached_context = defaultdict(bool, json.load(f))
-            # load context from cache if /usr/bin/mplayer isn't modified.
-            if cached_context['hash'] == self['hash']:
-                self['ass'] = cached_context['ass']
-                self['mplayer2'] = cached_context['mplayer2']
-                self['option'] = defaultdict(int, cached_context['option'])
-
-    def __rebuild_context(self):
-        options = fsdecode(subprocess.Popen([self['path'], '-list-options'], stdout=subprocess.PIPE).communicate()[0]).splitlines()
+# Probing engine: every probe result is cached on its own, keyed by the
+# content of the file it inspects, so that e.g. upgrading libass re-runs only
+# the libass probe.
+def fingerprint(path):
+    '''Return the MD5 of the file. The whole file is hashed only if its
+    (device, inode, size, mtime) has changed since the last call.
+    '''
+    key = '{0}\n{1}'.format(path, file_identity(path))
+    cache = DiskCache('fingerprint')
+    digest = cache.get(key)
+    if not digest:
+        with open(path,'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        cache.set(key, digest)
+    return digest
+
+def cached_probe(name, path, probe, refresh=False):
+    key = '{0}\n{1}'.format(name, fingerprint(path))
+    cache = DiskCache('probe')
+    result = None if refresh else cache.get(key)
+    if result is None:
+        log_debug('Probing {0} for {1}...'.format(name, path))
+        result = probe(path)
+        cache.set(key, result)
+    return result
+
+def probe_options(path):
+    options = fsdecode(subprocess.Popen([path, '-list-options'], stdout=subprocess.PIPE).communicate()[0]).splitlines()
+
+    result = {'mplayer2': False}
+    if options[-1].startswith('MPlayer2'):
+        result['mplayer2'] = True
+        option_end = -3
+    else:
+        option_end = -4
+
+    # collect supported options
+    option = defaultdict(int)
+    for opt in options[3:option_end]:
+        opt = opt.split()
+        name = opt[0].split(':') # don't care sub-option
+        if option[name[0]]:
+            continue
+        option[name[0]] = (2 if len(name)==2 or opt[1]!='Flag' else 1)
+
+    # handle vf*/af*: mplayer reports option name as vf*/af*, which is a
+    # family of options.
+    option.pop('af*', None)
+    option.pop('vf*', None)
+    for extra in ['af','af-adv','af-add','af-pre','af-del','vf','vf-add','vf-pre','vf-del']:
+        option[extra] = 2
+    for extra in ['af-clr','vf-clr']:
+        option[extra] = 1
+
+    result['option'] = dict(option)
+    return result
+
+def probe_libass(path):
+    '''Return the path of libass linked by the binary.
+    '''
+    for l in fsdecode(subprocess.check_output(['ldd',path])).splitlines():
+        if 'libass' in l:
+            return l.split()[2]
+    return ''
 
-        if options[-1].startswith('MPlayer2'):
-            self['mplayer2'] = True
-            option_end = -3
-        else:
-            option_end = -4
-
-        # collect supported options
-        self['option'] = defaultdict(int)
-        for opt in options[3:option_end]:
-            opt = opt.split()
-            name = opt[0].split(':') # don't care sub-option
-            if self['option'][name[0]]:
-                continue
-            self['option'][name[0]] = (2 if len(name)==2 or opt[1]!='Flag' else 1)
-            
-        # handle vf*/af*: mplayer reports option name as vf*/af*, which is a
-        # family of options.
-        del self['option']['af*']
-        del self['option']['vf*']
-        for extra in ['af','af-adv','af-add','af-pre','af-del','vf','vf-add','vf-pre','vf-del']:
-            self['option'][extra] = 2
-        for extra in ['af-clr','vf-clr']:
-            self['option'][extra] = 1
+def probe_fontconfig(path):
+    '''Return True if fontconfig is linked by the library.
+    '''
+    return 'libfontconfig' in fsdecode(subprocess.check_output(['ldd',path]))
 
-        # it's awful to test if ass is supported.
-        self['ass'] = True
-        if not self['option']['ass']:
-            self['ass'] = False
-        else:
-            libass_path = None
-            for l in fsdecode(subprocess.check_output(['ldd',self['path']])).splitlines():
-                if 'libass' in l:
-                    libass_path = l.split()[2]
-            if not libass_path:
-                self['ass'] = False
-            else:
-                if not 'libfontconfig' in fsdecode(subprocess.check_output(['ldd',libass_path])):
-                    self['ass'] = False
-                
 class MPlayerContext(defaultdict):
-    def __init__(self):
+    '''The capabilities of a player binary. Contexts of different binaries
+    (mplayer, mplayer2, mpv, ...) are cached side by side.
+    '''
+    def __init__(self, path=None):
         super(MPlayerContext,self).__init__(bool)
-        
-        for p in ['/opt/bin/mplayer','/usr/local/bin/mplayer','/usr/bin/mplayer']:
-            if which(p):
-                self['path'] = p
-                break
+
+        if path:
+            self['path'] = path
+        else:
+            for p in ['/opt/bin/mplayer','/usr/local/bin/mplayer','/usr/bin/mplayer']:
+                if which(p):
+                    self['path'] = p
+                    break
 
     def establish(self):
         # no mplayer binary presents
         if not self['path']:
             return
 
-        cache_file = os.path.join(config.get_cache_dir(), 'info')
+        cache_file = os.path.join(config.get_cache_dir(), 'context')
+        contexts = {}
         try:
-            self.__load_context(cache_file)
+            with open(cache_file,'rb') as f:
+                contexts = marshal.load(f)
+            if self.__load_context(contexts.get(self['path'])):
+                if not self.__libass_changed():
+                    return
+                # e.g. libass upgraded: only the libass probes are re-run
+                log_debug('{0} has changed.'.format(self['libass']))
+                self.__probe_ass()
+                self['ass'] = bool(self['option']['ass'] and self['fontconfig'])
+                self.__save(contexts, cache_file)
+                return
         except StandardError as e:
             log_debug('Load context from {} failed because: \n  {}'.format(cache_file, e))
 
-        if not self['option']:
-            self.__rebuild_context()
-            
-            try:
-                if not os.path.exists(config.get_cache_dir()):
-                    os.mkdir(config.get_cache_dir(),0o700)
-                with open(cache_file,'w') as f:
-                    json.dump(self, f)
-            except StandardError as e:
-                log_debug('Save context to {} failed because:\n  {}'.format(cache_file, e))
-
-    def __load_context(self, cache_file):
-        with open(self['path'],'rb') as f:
-            self['hash'] = hashlib.md5(f.read()).hexdigest()
-
-        with open(cache_file,'r') as f:
-            cached_context = defaultdict(bool, json.load(f))
-            # load context from cache if /usr/bin/mplayer isn't modified.
-            if cached_context['hash'] == self['hash']:
-                self['ass'] = cached_context['ass']
-                self['mplayer2'] = cached_context['mplayer2']
-                self['option'] = defaultdict(int, cached_context['option'])
+        self.__rebuild_context()
+        self.__save(contexts, cache_file)
+
+    def __save(self, contexts, cache_file):
+        try:
+            if not os.path.exists(config.get_cache_dir()):
+                os.mkdir(config.get_cache_dir(),0o700)
+            # marshal loads much faster than json and the context only
+            # consists of plain values.
+            contexts[self['path']] = dict((k, dict(v) if isinstance(v, dict) else v) for k,v in self.items())
+            atomic_write(cache_file, marshal.dumps(contexts))
+        except StandardError as e:
+            log_debug('Save context to {} failed because:\n  {}'.format(cache_file, e))
+
+    def __load_context(self, cached_context):
+        '''Return True if the cached context is loaded, i.e. the binary isn't
+        modified.
+        '''
+        if not cached_context or 'libass_stat' not in cached_context \
+           or cached_context.get('stat') != file_identity(self['path']):
+            return False
+        self.update(cached_context)
+        self['option'] = defaultdict(int, cached_context['option'])
+        return True
+
+    def __libass_changed(self):
+        if not self['libass']:
+            return False
+        try:
+            return file_identity(self['libass']) != self['libass_stat']
+        except OSError:
+            return True
+
+    def __probe_ass(self):
+        '''Find the libass linked by the binary and if it supports fontconfig.
+        Both probes are cached by content, so they only run for a new binary or
+        a new libass.
+        '''
+        self['libass'], self['libass_stat'], self['fontconfig'] = '', None, False
+        try:
+            path = cached_probe('libass', self['path'], probe_libass)
+            if path and not os.path.exists(path):
+                # libass has been upgraded to a new soname
+                path = cached_probe('libass', self['path'], probe_libass, refresh=True)
+            if path:
+                self['libass'], self['libass_stat'] = path, file_identity(path)
+                self['fontconfig'] = cached_probe('fontconfig', path, probe_fontconfig)
+        except (StandardError, subprocess.CalledProcessError) as e:
+            log_debug('Probing libass failed because:\n  {}'.format(e))
 
     def __rebuild_context(self):
-        options = fsdecode(subprocess.Popen([self['path'], '-list-options'], stdout=subprocess.PIPE).communicate()[0]).splitlines()
+        # Run the independent probes concurrently: '-list-options' in this
+        # thread, the ldd chain for libass in another one.
+        self['stat'] = file_identity(self['path'])
+        self['hash'] = fingerprint(self['path'])
 
-        if options[-1].startswith('MPlayer2'):
-            self['mplayer2'] = True
-            option_end = -3
-        else:
-            option_end = -4
-
-        # collect supported options
-        self['option'] = defaultdict(int)
-        for opt in options[3:option_end]:
-            opt = opt.split()
-            name = opt[0].split(':') # don't care sub-option
-            if self['option'][name[0]]:
-                continue
-            self['option'][name[0]] = (2 if len(name)==2 or opt[1]!='Flag' else 1)
-            
-        # handle vf*/af*: mplayer reports option name as vf*/af*, which is a
-        # family of options.
-        del self['option']['af*']
-        del self['option']['vf*']
-        for extra in ['af','af-adv','af-add','af-pre','af-del','vf','vf-add','vf-pre','vf-del']:
-            self['option'][extra] = 2
-        for extra in ['af-clr','vf-clr']:
-            self['option'][extra] = 1
+        ass_thread = threading.Thread(target=self.__probe_ass)
+        ass_thread.daemon = True
+        ass_thread.start()
+
+        result = cached_probe('options', self['path'], probe_options)
+        self['mplayer2'] = result['mplayer2']
+        option = defaultdict(int, result['option'])
 
         # it's awful to test if ass is supported.
-        self['ass'] = True
-        if not self['option']['ass']:
-            self['ass'] = False
-        else:
-            libass_path = None
-            for l in fsdecode(subprocess.check_output(['ldd',self['path']])).splitlines():
-                if 'libass' in l:
-                    libass_path = l.split()[2]
-            if not libass_path:
-                self['ass'] = False
-            else:
-                if not 'libfontconfig' in fsdecode(subprocess.check_output(['ldd',libass_path])):
-                    self['ass'] = False
+        ass_thread.join()
+        self['option'] = option
+        self['ass'] = bool(option['ass'] and self['fontconfig'])
 
 class MPlayerFifo(object):
     '''MPlayerFifo maintains a FIFO for IPC with mplayer.
+
+    The FIFO is kept open once mplayer has opened its end. Commands are queued
+    and written by a background thread, so send() never blocks.
+
+    Only the latest OSD text is kept. When more than max_pending commands are
+    queued, the oldest OSD text or query (whose waiter has most likely given
+    up) is dropped; the others (e.g. sub_load) are never dropped.
     '''
+    max_pending = 64
+
     def send(self, s):
-        if self.args:
-            log_debug('Sending message "{0}" to {1}...'.format(s, self.__path))
-            with open(self.__path,'w') as f:
-                f.write(fsencode(s+'\n'))
-        else:
+        if not self.args:
             log_info('"{0}" cannot be sent to the non-existing {1}.'.format(s, self.__path))
-    
+            return
+
+        log_debug('Sending message "{0}" to {1}...'.format(s, self.__path))
+        with self.__lock:
+            if s.startswith('osd_show_text'):
+                # only the latest OSD message is worth showing
+                for c in [c for c in self.__queue if c.startswith('osd_show_text')]:
+                    self.__queue.remove(c)
+            self.__queue.append(s)
+            if len(self.__queue) > self.max_pending:
+                for c in list(self.__queue):
+                    if self.__coalescible(c):
+                        self.__queue.remove(c)
+                        break
+            if not self.__writer:
+                self.__writer = threading.Thread(target=self.__write_queue)
+                self.__writer.daemon = True
+                self.__writer.start()
+
+    def reset(self):
+        '''Drop the pending commands and the connection to an exited mplayer.
+        '''
+        with self.__lock:
+            self.__queue.clear()
+            self.__close()
+
+    def __write_queue(self):
+        import errno, time
+        while True:
+            # The fd is only touched under the lock, so that reset() and
+            # remove() can't close it (and let its number be reused) in the
+            # middle of a write. Neither call blocks as the fd is non-blocking.
+            with self.__lock:
+                if not self.__queue or not self.args:
+                    self.__writer = None
+                    return
+                try:
+                    if self.__fd == None:
+                        self.__fd = os.open(self.__path, os.O_WRONLY|os.O_NONBLOCK)
+                    os.write(self.__fd, fsencode(self.__queue[0]+'\n'))
+                    self.__queue.popleft()
+                    continue
+                except OSError as e:
+                    if e.errno == errno.EPIPE:
+                        self.__close()
+                except Exception as e:
+                    # drop the bad command rather than let the writer die
+                    log_debug('Sending "{0}" failed because:\n  {1}'.format(self.__queue.popleft(), e))
+                    continue
+            # mplayer hasn't opened the FIFO yet, or is slow in reading
+            time.sleep(0.1)
+
+    @staticmethod
+    def __coalescible(s):
+        return s.startswith(('osd_show_text', 'get_', 'pausing_keep_force get_'))
+
+    def __close(self):
+        if self.__fd != None:
+            try:
+                os.close(self.__fd)
+            except OSError:
+                pass
+            self.__fd = None
+
     def __init__(self):
-        self.__path = os.path.join(config.get_runtime_dir(), 'mplayer.fifo')
+        from collections import deque
+        self.__path = os.path.join(config.get_runtime_dir(), 'mplayer-{0}-{1:x}.fifo'.format(os.getpid(), id(self)))
         
         try:
             os.mkfifo(self.__path)
         except OSError as e:
             log_info(e)
 
+        self.__fd = None
+        self.__queue = deque()
+        self.__lock = threading.Lock()
+        self.__writer = None
         self.args = '-input file={0}'.format(self.__path).split()
             
     def __del__(self):
+        self.remove()
+
+    def remove(self):
+        with self.__lock:
+            if not self.args:
+                return
+            self.args = []
+            self.__close()
         try:
             os.unlink(self.__path)
         except StandardError as e:
@@ -229,6 +304,7 @@ class MPlayerFifo(object):
 class MPlayer(object):
     last_timestamp = 0.0
     last_exit_status = None
+    last_stats = None
     
     def __init__(self, args=[], minimal=False):
         self.__context = MPlayerContext()
@@ -236,6 +312,8 @@ class MPlayer(object):
             self.__context.establish()
             self.__fifo = MPlayerFifo()
             self.__process = None
+            self.__waiters = []
+            self.__answer_lock = threading.Lock()
 
             self.__init_args(args)
             self.__set_default_args()
@@ -308,6 +386,57 @@ class MPlayer(object):
     def send(self, cmd):
         if self.__process != None:
             self.__fifo.send(cmd)
+
+    def query(self, cmd, timeout=1.0):
+        '''Send a get_* command (e.g. 'get_time_pos', 'get_property volume') to
+        the playing mplayer and return its answer, or None if there is no answer
+        within timeout seconds.
+
+        The answers (ANS_*) are picked out of the output by __tee().
+        '''
+        if self.__process == None:
+            return None
+
+        # the name of the expected answer
+        answers = {'get_time_pos': 'TIME_POSITION', 'get_time_length': 'LENGTH',
+                   'get_file_name': 'FILENAME', 'get_percent_pos': 'PERCENT_POSITION'}
+        name, _, arg = cmd.partition(' ')
+        key = arg.strip() if name == 'get_property' else answers.get(name)
+
+        waiter = [key, threading.Event(), None]
+        with self.__answer_lock:
+            self.__waiters.append(waiter)
+        # don't let a query resume a paused playback
+        self.send('pausing_keep_force ' + cmd)
+        waiter[1].wait(timeout)
+        with self.__answer_lock:
+            if waiter in self.__waiters:
+                self.__waiters.remove(waiter)
+        return waiter[2]
+
+    def wait_until_playing(self, timeout=10.0):
+        '''Wait until mplayer starts playing. Return the playback position, or
+        None if timed out.
+        '''
+        import time
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            pos = self.query('get_time_pos', timeout=min(0.5, max(0, deadline-time.time())))
+            if pos != None:
+                return pos
+            time.sleep(0.1)
+        return None
+
+    def __answer(self, line):
+        key,_,value = fsdecode(line).strip()[4:].partition('=')
+        value = value.strip("'")
+        with self.__answer_lock:
+            for waiter in self.__waiters:
+                if key == 'ERROR' or waiter[0] in [None, key]:
+                    waiter[2] = None if key == 'ERROR' else value
+                    waiter[1].set()
+                    self.__waiters.remove(waiter)
+                    break
         
     def identify(self, args):
         args = [ self.__context['path'] ] + '-vo null -ao null -frames 0 -identify'.split() + args
@@ -315,46 +444,97 @@ class MPlayer(object):
         output = subprocess.Popen(args,stdout=subprocess.PIPE,stderr=DEVNULL).communicate()[0]
         return '\n'.join([l for l in fsdecode(output).splitlines() if l.startswith('ID_')])
     
-    def play(self, args=[]):
+    def play(self, args=[], replace=False):
+        '''Play with mplayer. If replace is True, nothing is done by the wrapper
+        during or after the playback, so mplayer replaces the current process
+        instead of being run and tee'd as a child.
+        '''
         args = [ self.__context['path'] ] + self.__cmdline_args + args
         log_debug('\n'+' '.join(args))
-        if not config.DRY_RUN:
+        if not config.DRY_RUN and replace:
+            self.__fifo.remove()
+            config.clean_runtime_dir()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.execv(args[0], [fsencode(a) for a in args])
+        elif not config.DRY_RUN:
             self.__process = subprocess.Popen(args, stdin=sys.stdin, stdout=subprocess.PIPE, stderr=None)
             self.__tee()
 
     def __tee(self):
-        def flush_first_line(fileobj, lines):
-            fileobj.write(b''.join(lines.pop(0)))
-            fileobj.flush()
-            lines.append([])
+        import re, select, time
+        from collections import deque
+        from telemetry import PlaybackStats
 
         f = sys.stdout
-        p = self.__process
-        
+        fd = self.__process.stdout.fileno()
+
+        # mplayer updates the status line ('\r' terminated) at frame rate;
+        # only the latest one is shown every interval.
+        interval = 1.0/config.STATUS_REFRESH_RATE if config.STATUS_REFRESH_RATE else 0
+        last_refresh = 0
+        pending = None
+
+        stats = PlaybackStats()
+
         # cache 5 lines in case of unexpected outputs
-        lines = [[] for i in range(5)]
+        lines = deque(maxlen=5)
+        line_re = re.compile(b'[^\r\n]*(?:\r\n|\r|\n)')
+        rest = b''
         while True:
-            c = p.stdout.read(1)
-            if not c:
+            if pending and not select.select([fd],[],[],max(0, last_refresh+interval-time.time()))[0]:
+                f.write(pending)
+                f.flush()
+                pending = None
+                last_refresh = time.time()
+                continue
+
+            chunk = os.read(fd, 4096)
+            if not chunk:
                 break
-            lines[4].append(c)
-
-            # carriage return / linefeed
-            if c == b'\n':
-                flush_first_line(f,lines)
-            elif c == b'\r':
-                d = p.stdout.read(1)
-                if d == b'\n':
-                    lines[4].append(b'\n')
-                    flush_first_line(f,lines)
+
+            out = []
+            end = 0
+            for m in line_re.finditer(rest + chunk):
+                l = m.group()
+                end = m.end()
+                if l == b'\n' and lines and lines[-1].endswith(b'\r'):
+                    # a '\r\n' split between two chunks
+                    lines[-1] += l
+                    if pending:
+                        out.append(pending)
+                        pending = None
+                    out.append(l)
+                    continue
+                if l.startswith(b'ANS_'):
+                    self.__answer(l)
+                    continue
+                lines.append(l)
+                if l.endswith(b'\r\n') or not l.endswith(b'\r'):
+                    if pending:
+                        out.append(pending)
+                        pending = None
+                    out.append(l)
+                    continue
+
+                stats.feed(l)
+                if time.time()-last_refresh >= interval:
+                    pending = None
+                    out.append(l)
+                    last_refresh = time.time()
                 else:
-                    flush_first_line(f,lines)
-                    lines[4].append(d)
-            else:
-                pass
+                    pending = l
+            rest = (rest + chunk)[end:]
+
+            if out:
+                f.write(b''.join(out))
+                f.flush()
+
+        if rest:
+            lines.append(rest)
 
         # save info and flush rest outputs
-        for l in (b''.join(ll) for ll in lines):
+        for l in lines:
             if l.startswith((b'A:',b'V:')):
                 try:
                     self.last_timestamp = float(l[2:9])
@@ -362,12 +542,19 @@ class MPlayer(object):
                     pass
             if l.startswith(b'Exiting...'):
                 self.last_exit_status = l[12:len(l)-2]
-            f.write(l)
+        f.write((pending or b'') + rest)
         f.flush()
 
+        self.last_stats = stats.summary()
+
         log_debug('Last timestamp: {0}'.format(self.last_timestamp))
         log_debug('Last exit status: {0}'.format(self.last_exit_status))
         self.__process = None
+        self.__fifo.reset()
+        with self.__answer_lock:
+            for waiter in self.__waiters:
+                waiter[1].set()
+            self.__waiters = []
 
 if __name__ == '__main__':
     import sys
@@ -5,20 +5,116 @@
 # Time-stamp: <2013-08-01 18:11:36 by subi>
 
 from __future__ import unicode_literals
-import urllib2
 
 from globals import *
+from httpclient import HTTPClient
 
 # interface
-def fetch_and_save_subtitle(path, shash, savedir=None):
-    subs = fetch_shooter(path, shash)
-    force_utf8_and_filter_duplicates(subs)
+def fetch_and_save_subtitle(path, shash, savedir=None, osd=True, deadline=None):
+    subs = load_package(shash)
+    if subs == None:
+        subs = fetch_shooter(path, shash, osd, deadline)
+        if subs == None:
+            return []
+        save_package(shash, subs)
+    subs = force_utf8_and_filter_duplicates(subs)
     save_to_disk(subs, path, savedir)
     return [s['path'] for s in subs]
-    
+
+def convert_to_utf8(path):
+    '''Convert the subtitle file to UTF-8 in place. The result is streamed
+    into a temporary file which then replaces the original, so that an
+    interrupted conversion never corrupts it.
+
+    Files known to be in UTF-8, i.e. of the same file_identity() as last seen,
+    are skipped without being read.
+
+    Return the encoding of the file afterwards: 'utf_8' if it is in UTF-8 now,
+    the detected one if it couldn't be converted, or None if unknown.
+    '''
+    from cache import atomic_file
+    from charset import guess_file_locale, convert_file
+
+    path = os.path.abspath(path)
+    known = DiskCache('utf8')
+    enc = None
+    try:
+        if known.get(path) == file_identity(path):
+            return 'utf_8'
+        with open(path,'rb') as f:
+            enc,_ = guess_file_locale(f)
+            if not enc in ['utf_8','ascii']:
+                log_debug('Converting {0} from {1} to UTF-8...'.format(path, enc))
+                f.seek(0)
+                with atomic_file(path) as out:
+                    convert_file(f, out)
+        identity = file_identity(path)
+    except (IOError, OSError) as e:
+        log_info('Failed to convert {0} to UTF-8 because:\n  {1}'.format(path, e))
+        return enc
+    known.set(path, identity)
+    return 'utf_8'
+
+def shooter_hash(path):
+    '''Return the hash by which shooter identifies the video, i.e. the MD5s
+    of four 4KB blocks, or None if the file is too small.
+
+    The hash only depends on the content, so it is cached by (device, inode,
+    size, mtime) and computed once per file.
+    '''
+    st = os.stat(path)
+    if st.st_size <= 8192:
+        return None
+
+    key = file_identity(path)
+    cache = DiskCache('shash')
+    shash = cache.get(key)
+    if not shash:
+        offsets = [4096, st.st_size//3*2, st.st_size//3, st.st_size-8192]
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if hasattr(os, 'posix_fadvise'):
+                # let the kernel fetch the blocks concurrently
+                for offset in offsets:
+                    os.posix_fadvise(fd, offset, 4096, os.POSIX_FADV_WILLNEED)
+            shash = ';'.join([hashlib.md5(pread(fd, 4096, offset)).hexdigest() for offset in offsets])
+        finally:
+            os.close(fd)
+        cache.set(key, shash)
+    return shash
+
 # implementation
 from charset import guess_locale_and_convert
-import hashlib,time,io
+import hashlib,time,threading,base64
+from collections import defaultdict
+from cache import DiskCache
+from aux import file_identity
+
+def load_package(shash):
+    '''Return the subtitles once fetched for the video of shash, no matter
+    where the video is. An empty answer is only trusted for
+    config.NO_SUBTITLE_TTL seconds.
+    '''
+    if not shash:
+        return None
+    cached = DiskCache('subtitle', config.SUBTITLE_CACHE_SIZE).get(shash)
+    if not cached:
+        return None
+    if not cached['subtitles'] and time.time() - cached['time'] > config.NO_SUBTITLE_TTL:
+        return None
+    log_debug('Use the cached subtitles for {0}.'.format(shash))
+    return [{'extension': s['extension'],
+             'delay': s['delay'],
+             'content': base64.b64decode(s['content'])} for s in cached['subtitles']]
+
+def save_package(shash, subtitles):
+    if not shash or config.DRY_RUN:
+        return
+    cached = {'time': time.time(),
+              'subtitles': [{'extension': s['extension'],
+                             'delay': s['delay'],
+                             'content': base64.b64encode(s['content'])} for s in subtitles]}
+    DiskCache('subtitle', config.SUBTITLE_CACHE_SIZE).set(shash, cached)
 
 def save_to_disk(subtitles, filepath, save_dir):
     prefix,_ = os.path.splitext(filepath)
@@ -39,104 +135,272 @@ def save_to_disk(subtitles, filepath, save_dir):
             s['path'] = path
 
 def force_utf8_and_filter_duplicates(subtitles):
+    '''Convert the subtitles to UTF-8 and return them without duplicates.
+
+    Subtitles of the same extension and language are compared by the MinHash
+    signatures of their cue texts, so that retimed or restyled copies are
+    found as well. Candidate pairs come from locality-sensitive hashing of
+    the signatures, which keeps the work roughly linear. The longer subtitle
+    of a duplicated pair is reserved.
+    '''
     log_debug('Trying to filter duplicated subtitles...')
 
     for s in subtitles:
         _,s['lang'],s['content'] = guess_locale_and_convert(s['content'])
-            
+
+    signatures = [minhash(cue_texts(s['content'])) for s in subtitles]
+    rows = len(signatures[0])//minhash_bands if signatures else 0
+    buckets = defaultdict(list)
+    for i,(s,sig) in enumerate(zip(subtitles, signatures)):
+        for band in range(minhash_bands):
+            buckets[(s['extension'], s['lang'], band, tuple(sig[band*rows:(band+1)*rows]))].append(i)
+
     dup_tag = [False]*len(subtitles)
-    for i in range(len(subtitles)):
-        if dup_tag[i]:
-            continue
-        for j in range(i+1, len(subtitles)):
-            sa = subtitles[i]
-            sb = subtitles[j]
-            if sa['extension'] != sb['extension'] or sa['lang'] != sb['lang']:
-                continue
-            import difflib
-            similarity = difflib.SequenceMatcher(None, sa['content'], sb['content']).real_quick_ratio()
-            log_debug('Similarity is {0}.'.format(similarity))
-            if similarity > 0.9:
-                dup_tag[j] = True
-    # TODO: reserve longer subtitles 
+    compared = set()
+    for candidates in buckets.values():
+        for n,i in enumerate(candidates):
+            for j in candidates[n+1:]:
+                if (i,j) in compared or dup_tag[i] or dup_tag[j]:
+                    continue
+                compared.add((i,j))
+                similarity = sum(a==b for a,b in zip(signatures[i], signatures[j])) / float(len(signatures[i]))
+                log_debug('Similarity is {0}.'.format(similarity))
+                if similarity > 0.9:
+                    shorter = i if len(subtitles[i]['content']) < len(subtitles[j]['content']) else j
+                    dup_tag[shorter] = True
+
     subtitles = [subtitles[i] for i in range(len(subtitles)) if not dup_tag[i]]
     log_debug('{0} subtitle(s) reserved after duplicates filtering.'.format(len(subtitles)))
+    return subtitles
+
+if hasattr(os, 'pread'):
+    pread = os.pread
+else:
+    def pread(fd, n, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, n)
+
+minhash_bands = 8
+# (a*x + b) mod p as the family of hash permutations
+minhash_permutations = [((i*0x9E3779B1 + 0x7F4A7C15) % 0xFFFFFFFB or 1, (i*0x85EBCA6B + 0xC2B2AE35) % 0xFFFFFFFB)
+                        for i in range(1, 33)]
+
+def minhash(shingles):
+    hashes = [int(hashlib.md5(x).hexdigest()[0:8], 16) for x in shingles] or [0]
+    return [min((a*h + b) % 0xFFFFFFFB for h in hashes) for a,b in minhash_permutations]
 
-def parse_shooter_package(fileobj):
+def cue_texts(content):
+    '''Return the set of normalized text lines of the subtitle, ignoring
+    counters, timings, styles and spaces.
+    '''
+    import re
+    texts = set()
+    for l in content.splitlines():
+        if l.startswith(b'Dialogue:'):
+            # ASS/SSA: the text is the 10th field
+            l = l.split(b',', 9)[-1]
+        elif b'-->' in l or l.strip().isdigit() or l.startswith((b'[', b'Style:', b'Format:')):
+            continue
+        l = re.sub(br'\{[^}]*\}|<[^>]*>|\\[Nnh]|\s+', b'', l).lower()
+        if l:
+            texts.add(l)
+    return texts
+
+def read_exactly(f, n):
+    data = f.read(n)
+    if len(data) != n:
+        raise ValueError('The package of subtitles is truncated.')
+    return data
+
+def skip_exactly(f, n, chunk_size=64*1024):
+    while n:
+        n -= len(read_exactly(f, min(n, chunk_size)))
+
+def parse_shooter_package(fileobj, max_size=None, max_count=None):
     '''Parse shooter returned package of subtitles.
-    Return subtitles encoded in UTF-8.
+
+    The package is read as a stream: every subtitle is read (and gunzipped)
+    in chunks, and the lengths in the package are never trusted, i.e. a
+    subtitle larger than max_size bytes (config.MAX_SUBTITLE_SIZE by default)
+    is skipped without being kept in memory, and at most max_count
+    (config.MAX_SUBTITLE_COUNT) subtitles are kept.
     '''
+    import struct, zlib
+    max_size = max_size or config.MAX_SUBTITLE_SIZE
+    max_count = max_count or config.MAX_SUBTITLE_COUNT
+    chunk_size = 64*1024
+
     subtitles = []
     f = fileobj
 
     # read contents
-    import struct
     c = f.read(1)
-    package_count = struct.unpack(b'!b', c)[0]
+    package_count = struct.unpack(b'!b', c)[0] if c else 0
 
     for i in range(package_count):
         # NOTE: '_' is the length of following byte-stream
-        c = f.read(8)
-        _,desc_length = struct.unpack(b'!II', c)
-        description = f.read(desc_length).decode('utf_8')
-        sub_delay = description.partition('=')[2] / 1000.0 if description and 'delay' in description else 0
+        _,desc_length = struct.unpack(b'!II', read_exactly(f, 8))
+        description = read_exactly(f, min(desc_length, 4096)).decode('utf_8','ignore')
+        skip_exactly(f, desc_length - min(desc_length, 4096), chunk_size)
+        try:
+            sub_delay = float(description.partition('=')[2]) / 1000.0 if 'delay' in description else 0
+        except ValueError:
+            sub_delay = 0
         if description:
             log_debug('Subtitle description: {0}'.format(description))
 
-        c = f.read(5)
-        _,file_count = struct.unpack(b'!IB', c)
+        _,file_count = struct.unpack(b'!IB', read_exactly(f, 5))
             
         for j in range(file_count):
-            c = f.read(8)
-            _,ext_len = struct.unpack(b'!II', c)
-            ext = f.read(ext_len)
+            _,ext_len = struct.unpack(b'!II', read_exactly(f, 8))
+            if ext_len > 16:
+                raise ValueError('The extension of a subtitle is {0} bytes long.'.format(ext_len))
+            ext = read_exactly(f, ext_len)
 
-            c = f.read(4)
-            file_len = struct.unpack(b'!I', c)[0]
-            sub = f.read(file_len)
-            if sub.startswith(b'\x1f\x8b'):
-                import gzip
-                sub = gzip.GzipFile(fileobj=io.BytesIO(sub)).read()
+            file_len = struct.unpack(b'!I', read_exactly(f, 4))[0]
+            sub = []
+            size = 0
+            gunzip = None
+            left = file_len
+            while left:
+                data = read_exactly(f, min(left, chunk_size))
+                left -= len(data)
+                if size > max_size:
+                    # oversized, just skip the rest
+                    continue
+                if left + len(data) == file_len and data.startswith(b'\x1f\x8b'):
+                    gunzip = zlib.decompressobj(16+zlib.MAX_WBITS)
+                if gunzip:
+                    # never decompress beyond the limit
+                    data = gunzip.decompress(data, max_size+1-size)
+                    if gunzip.unconsumed_tail:
+                        size = max_size+1
+                size += len(data)
+                sub.append(data)
 
-            subtitles.append({'extension': ext,
-                              'delay': sub_delay,
-                              'content': sub})
+            if size > max_size:
+                log_info('Skipped a subtitle larger than {0} bytes.'.format(max_size))
+            elif len(subtitles) >= max_count:
+                log_info('Skipped subtitles beyond {0}.'.format(max_count))
+            else:
+                subtitles.append({'extension': ext,
+                                  'delay': sub_delay,
+                                  'content': b''.join(sub)})
 
     log_debug('{0} subtitle(s) fetched.'.format(len(subtitles)))
     return subtitles
 
-def fetch_shooter(filepath,filehash):
+# limit the number of concurrent requests to shooter.cn
+request_slots = threading.BoundedSemaphore(config.MAX_REQUESTS)
+
+def fetch_shooter(filepath,filehash,osd=True,deadline=None):
+    '''Query shooter.cn until an answer is received or the deadline (in
+    seconds, config.FETCH_DEADLINE by default) passes. The first try is sent
+    immediately and the following ones after jittered exponential backoff.
+
+    Return None if there is no answer at all.
+    '''
     if config.DRY_RUN:
         log_info('fetch_shooter() ---> Dry-running:\n Fetching subtitles for {0}.'.format(filepath))
-        return None
+        return []
+
+    def show_text(s, duration):
+        if osd:
+            singleton.get_mplayer().send('osd_show_text "{0}" {1}'.format(s, duration))
+
+    import random
+    end = time.time() + (deadline or config.FETCH_DEADLINE)
+    backoff = 2.0
+    i = 0
+    while True:
+        i += 1
+        log_debug('Querying subtitles for {0} (Try {1})...'.format(filepath, i))
+        show_text('正在查询字幕...', 5000)
+        fetched_subtitles = query_shooter(filepath, filehash, end-time.time())
+        if fetched_subtitles != None:
+            # an empty answer means there is no subtitle at all
+            return fetched_subtitles
+        show_text('查询字幕失败.', 3000)
 
-    # fetch
-    fetched_subtitles = []
-    tries = [2, 10, 30, 60, 120]
-    for i, t in enumerate(tries):
-        log_debug('Wait for {0}s to reconnect (Try {1} of {2})...'.format(t,i+1,len(tries)+1))
-        time.sleep(t)
+        wait = min(random.uniform(0.5, 1.5) * backoff, end-time.time())
+        if wait <= 0:
+            log_debug('Give up querying subtitles for {0}.'.format(filepath))
+            return None
+        log_debug('Wait for {0:.1f}s to reconnect...'.format(wait))
+        time.sleep(wait)
+        backoff = min(backoff*2, 60)
 
-        req = prepare_request(filepath, filehash)
-        
+def query_shooter(filepath, filehash, timeout):
+    '''Send the query to the best ranked mirror. If it doesn't answer within
+    config.HEDGE_DELAY seconds, send a hedged query to the second best one as
+    well. Return the subtitles of the first answer, or None if no answer is
+    received within timeout seconds.
+    '''
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    header, data = prepare_request(filepath, filehash)
+    ranked = client.rank(mirrors)
+    answers = queue.Queue()
+
+    def ask(mirror):
+        url = mirror + '/api/subapi.php'
+        log_debug('Connecting server {0}...'.format(url))
+        def read_package(response):
+            if response.status == 200:
+                return parse_shooter_package(response)
         try:
-            singleton.get_mplayer().send('osd_show_text "正在查询字幕..." 5000')
-            response = urllib2.urlopen(req)
-        except StandardError as e:
-            singleton.get_mplayer().send('osd_show_text "查询字幕失败." 3000')
+            status, subtitles = client.request(url, data, header, read_package)
+            if status != 200:
+                log_debug('{0} responded with HTTP {1}.'.format(url, status))
+            answers.put(subtitles)
+        except Exception as e:
             log_debug(e)
-        else:
-            fetched_subtitles = parse_shooter_package(response)
-            response.close()
-            if fetched_subtitles:
-                break
+            answers.put(None)
+        finally:
+            request_slots.release()
+    def spawn(mirror):
+        if not request_slots.acquire(False):
+            return False
+        t = threading.Thread(target=ask, args=(mirror,))
+        t.daemon = True
+        t.start()
+        return True
 
-    return fetched_subtitles
+    end = time.time() + timeout
+    # poll for a request slot, the other fetches hold them until answered
+    while not spawn(ranked[0]):
+        if time.time() >= end:
+            log_debug('No request slot is available before the deadline.')
+            return None
+        time.sleep(0.05)
+    start = time.time()
+    pending = 1
+    hedged = not config.HEDGE_DELAY or len(ranked) < 2
+    while pending:
+        now = time.time()
+        wait = end - now if hedged else min(end, start+config.HEDGE_DELAY) - now
+        try:
+            answer = answers.get(True, max(wait, 0.01))
+        except queue.Empty:
+            if time.time() >= end:
+                return None
+            if not hedged:
+                hedged = True
+                if spawn(ranked[1]):
+                    log_debug('{0} is slow, sending a hedged query.'.format(ranked[0]))
+                    pending += 1
+            continue
+        pending -= 1
+        if answer != None:
+            return answer
+    return None
 
 def prepare_request(filepath, filehash):
-    import httplib
-    schemas = ['http', 'https'] if hasattr(httplib, 'HTTPS') else ['http']
-    servers = ['www', 'splayer', 'svplayer'] + ['splayer'+str(i) for i in range(1,13)]
+    '''Return the header and the data to submit for the video.
+    '''
     splayer_rev = 2437 # as of 2012-07-02
 
     # generate data for submission
@@ -157,20 +421,21 @@ def prepare_request(filepath, filehash):
                     '{2}\n'.format(boundary, *d) for d in items]
                    + ['--' + boundary + '--'])
 
-    url = '{0}://{1}.shooter.cn/api/subapi.php'.format(random.choice(schemas), random.choice(servers))
-
-    log_debug('Connecting server {} with the submission:\n'
+    log_debug('Submission:\n'
               '\n'
               '{}\n'
-              '{}\n'.format(url,
-                            '\n'.join(['{0}:{1}'.format(*h) for h in header]),
+              '{}\n'.format('\n'.join(['{0}:{1}'.format(*h) for h in header]),
                             data))
 
     # shooter.cn uses UTF-8.
-    req = urllib2.Request(url.encode('utf_8'))
-    for h in header:
-        req.add_header(h[0].encode('utf_8'), h[1].encode('utf_8'))
-    req.add_data(data.encode('utf_8'))
+    return dict((h[0].encode('utf_8'), h[1].encode('utf_8')) for h in header), data.encode('utf_8')
+
+def shooter_mirrors():
+    import httplib
+    schemas = ['http', 'https'] if hasattr(httplib, 'HTTPS') else ['http']
+    servers = ['www', 'splayer', 'svplayer'] + ['splayer'+str(i) for i in range(1,13)]
+    return ['{0}://{1}.shooter.cn'.format(scheme, server) for scheme in schemas for server in servers]
 
-    return req
-    
+# The mirrors can be replaced, e.g. by a local stand-in server for testing.
+mirrors = shooter_mirrors()
+client = HTTPClient('shooter')
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2010-2013 Bing Sun <subi.the.dream.walker@gmail.com>
+
+# Performance metrics collected from the mplayer status line.
+from __future__ import unicode_literals
+import re, json, time
+from array import array
+
+from globals import *
+
+# A:  12.3 V:  12.3 A-V:  0.001 ct:  0.010  300/300  5%  1%  0.3% 2 0 45%
+#
+# i.e. audio/video position, A-V drift, total A-V sync correction, decoded and
+# displayed frames, CPU usage of video codec/video output/audio, dropped
+# frames, postprocessing level and cache fill.
+status_re = re.compile(b'A:\s*(-?[\d.]+)\s+V:\s*(-?[\d.]+)\s+A-V:\s*(-?[\d.]+)\s+ct:\s*(-?[\d.]+)'
+                       b'\s+\d+/\s*\d+\s+(\S+)%\s+(\S+)%\s+(\S+)%\s+(\d+)\s+-?\d+(?:\s+(\d+)%)?')
+
+def percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values)-1, int(len(values)*p/100.0))]
+
+class PlaybackStats(object):
+    '''PlaybackStats accumulates the status lines of one playback.
+    '''
+    def __init__(self):
+        self.__drift = array(b'd')
+        self.__cpu = [array(b'd') for i in range(3)]
+        self.__cache = array(b'd')
+        self.__dropped = 0
+        self.__position = 0.0
+
+    def feed(self, line):
+        m = status_re.match(line)
+        if not m:
+            return
+        g = m.groups()
+        try:
+            self.__position = float(g[1])
+            self.__drift.append(abs(float(g[2])))
+            self.__dropped = int(g[7])
+            if g[8]:
+                self.__cache.append(float(g[8]))
+        except ValueError:
+            return
+        # CPU usage may be reported as '??'
+        for i,v in enumerate(g[4:7]):
+            try:
+                self.__cpu[i].append(float(v))
+            except ValueError:
+                pass
+
+    def summary(self):
+        if not self.__drift:
+            return None
+        drift = sorted(self.__drift)
+        cpu = [sorted(c) for c in self.__cpu]
+        cache = sorted(self.__cache)
+        return {'samples': len(drift),
+                'position': self.__position,
+                'dropped': self.__dropped,
+                'av_drift': {'p50': percentile(drift, 50),
+                             'p90': percentile(drift, 90),
+                             'p99': percentile(drift, 99),
+                             'max': drift[-1]},
+                'cpu': dict((name, {'p50': percentile(c, 50), 'p90': percentile(c, 90)})
+                            for name,c in zip(['video', 'output', 'audio'], cpu)),
+                'cache': {'min': cache[0], 'p10': percentile(cache, 10)} if cache else None}
+
+def save_metrics(path, summary, max_size=1024*1024):
+    '''Append a JSON record of the playback summary to the metrics file in the
+    cache dir. The file is rotated when it grows larger than max_size.
+    '''
+    if not summary:
+        return
+    metrics_file = os.path.join(config.get_cache_dir(), 'metrics')
+    record = dict(summary, path=path, time=int(time.time()))
+    try:
+        if not os.path.exists(config.get_cache_dir()):
+            os.makedirs(config.get_cache_dir(),0o700)
+        if os.path.exists(metrics_file) and os.path.getsize(metrics_file) > max_size:
+            os.rename(metrics_file, metrics_file + '.1')
+        with open(metrics_file, 'ab') as f:
+            f.write(json.dumps(record, sort_keys=True).encode('utf_8') + b'\n')
+    except (IOError, OSError) as e:
+        log_debug('Save metrics to {0} failed because:\n  {1}'.format(metrics_file, e))